@@ -1,12 +1,19 @@
+from array import array
+from collections import Counter
+import heapq, itertools, math
+from tokenizer import START
+
 class ViterbiCell(object):
-    def __init__(self, n_1_gram, log_p, parent, used_words):
+    def __init__(self, n_1_gram, log_p, parent, remaining):
         """
-        used_words is a set of words that have been used up to this path.
+        n_1_gram holds the bag slots of its words (or the start slot),
+        and remaining packs how many of each distinct word are left after
+        this path, see _remaining_counts.
         """
         self.n_1_gram = n_1_gram
         self.log_p = log_p
         self.parent = parent
-        self.used_words = used_words
+        self.remaining = remaining
 
 def uniqueify(words):
     return ["{0}:{1}".format(i, w) for i, w in enumerate(words)]
@@ -14,30 +21,238 @@ def uniqueify(words):
 def deuniqueify(words):
     return [(w.split(":", 2)[1] if ':' in w else w) for w in words]
 
-def most_likely_sequence(word_bag, model, n):
+def _remaining_counts(counts):
+    """
+    Packs counts, the number of each distinct word left, into a single
+    int: count i is digit i of a mixed radix number with radixes
+    count + 1. Returns the packed counts and the weight of each digit,
+    so word i is left iff remaining // weights[i] % (counts[i] + 1) and
+    using one subtracts weights[i].
+    """
+    remaining = 0
+    weights = []
+    weight = 1
+    for count in counts:
+        weights.append(weight)
+        remaining += count * weight
+        weight *= count + 1
+    return remaining, weights
+
+def score_table(words, model, n, batch_model=None):
+    """
+    Returns an array of the log probability of every n-gram that can be
+    made from words (distinct words) after start padding: the n-gram
+    with word indexes (i_1, ..., i_n), index len(words) being the start
+    token, is at index ((i_1 * (k + 1) + i_2) * (k + 1) + ...) * k + i_n
+    for k = len(words), and n-grams with a start token after a word are
+    left at -inf. batch_model, if given, is a function scoring a list of
+    n-grams at once, e.g. katzbackoff.LanguageModel.log_p_katz_batch,
+    and is used instead of model.
+    """
+    tokens = list(words) + [START]
+    start = len(words)
+    indexes = []
+    n_grams = []
+    for i, history in enumerate(itertools.product(range(start + 1), repeat=n - 1)):
+        if any(a != start and b == start for a, b in zip(history, history[1:])):
+            continue
+        history_words = tuple(tokens[w] for w in history)
+        for w, word in enumerate(words):
+            indexes.append(i * start + w)
+            n_grams.append(history_words + (word,))
+    table = array('d', [-math.inf]) * ((start + 1) ** (n - 1) * start)
+    log_ps = batch_model(n_grams) if batch_model is not None else map(model, n_grams)
+    for i, log_p in zip(indexes, log_ps):
+        table[i] = log_p
+    return table
+
+def most_likely_sequence(word_bag, model, n, beam_width=None,
+                         use_score_table=False, batch_model=None):
     """
     word_bag is a list (i.e. multiset) of words
     model is a function which, given an n_gram (w_1, ..., w_n), returns log P(w_n|w_1...w_n-1)
+    beam_width, if given, is the number of highest scoring cells kept per
+    layer; by default every cell is kept
+    use_score_table scores every n-gram the bag can make once up front
+    (see score_table) instead of calling model during the search;
+    giving batch_model implies it
+
+    Repeated words are interchangeable: the bag is searched as distinct
+    words with counts, and a path always uses the copies of a word in
+    the same order, so paths that differ only in which copy of a word
+    they used are one path. Cells are keyed by the slots of their
+    n-1 gram, slot first_slots[w] + j being the jth use of word w. Words
+    are only looked up to call model.
+
+    Like keying cells by bag positions, this keeps only the best path
+    into each key, whatever words it has left, but paths are split by
+    how many copies of a word they used rather than by which copy. So
+    for bags with repeated words the result can differ from a search
+    over bag positions, for better or worse; for bags without, it's the
+    same.
     """
-    last_words = [ViterbiCell(tuple("<s>" for i in range(n - 1)), 0.0, None, set())]
-    word_bag = uniqueify(word_bag)
+    counts = Counter(word_bag)
+    distinct = len(counts)
+    words = [] # word of each slot, the last slot being the start token
+    word_indexes = [] # index in counts of each slot's word
+    first_slots = []
+    for w, (word, count) in enumerate(counts.items()):
+        first_slots.append(len(words))
+        words.extend(word for j in range(count))
+        word_indexes.extend(w for j in range(count))
+    words.append(START)
+    word_indexes.append(distinct)
+    table = None
+    if use_score_table or batch_model is not None:
+        table = score_table(list(counts), model, n, batch_model)
+    remaining, weights = _remaining_counts(counts.values())
+    last_words = [ViterbiCell(tuple(len(word_bag) for i in range(n - 1)), 0.0, None,
+                              remaining)]
     for i in range(len(word_bag)):
         next_layer = {} # map of n-1 gram to ViterbiCell
-        for word in word_bag:
-            for last_word in last_words:
-                if word not in last_word.used_words:
-                    n_gram = last_word.n_1_gram + (word,)
-                    n_1_gram = last_word.n_1_gram[1:] + (word,)
-                    log_p = last_word.log_p + model(tuple(deuniqueify(n_gram)))
-                    if n_1_gram not in next_layer or log_p > next_layer[n_1_gram].log_p:
+        # per cell: its history (as words, or as the offset of its row in
+        # table), and its n-1 gram minus the first slot
+        expansions = []
+        for cell in last_words:
+            # for n = 1 the n-1 gram still holds the last slot, for backtracking
+            history_slots = cell.n_1_gram[len(cell.n_1_gram) - n + 1:]
+            if table is None:
+                history = tuple(words[slot] for slot in history_slots)
+            else:
+                history = 0
+                for slot in history_slots:
+                    history = history * (distinct + 1) + word_indexes[slot]
+                history *= distinct
+            expansions.append((cell, history, cell.n_1_gram[1:]))
+        for w, (first_slot, count, weight) in enumerate(
+                zip(first_slots, counts.values(), weights)):
+            word = (words[first_slot],)
+            for last_word, history, tail in expansions:
+                left = last_word.remaining // weight % (count + 1)
+                if left:
+                    n_1_gram = tail + (first_slot + count - left,)
+                    if table is None:
+                        log_p = last_word.log_p + model(history + word)
+                    else:
+                        log_p = last_word.log_p + table[history + w]
+                    cell = next_layer.get(n_1_gram, None)
+                    if cell is None or log_p > cell.log_p:
                         next_layer[n_1_gram] = ViterbiCell(
-                            n_1_gram, log_p, last_word, last_word.used_words | set([word]))
+                            n_1_gram, log_p, last_word, last_word.remaining - weight)
         last_words = list(next_layer.values())
+        if beam_width is not None and len(last_words) > beam_width:
+            last_words = heapq.nlargest(beam_width, last_words, key=lambda x: x.log_p)
     ending_cell = max(last_words, key=lambda x: x.log_p)
     word_sequence = []
     cell = ending_cell
     while cell.parent is not None:
-        word_sequence.append(cell.n_1_gram[-1])
+        word_sequence.append(words[cell.n_1_gram[-1]])
         cell = cell.parent
     word_sequence.reverse()
-    return deuniqueify(word_sequence)
+    return word_sequence
+
+def exact_most_likely_sequence(word_bag, model, n, batch_model=None):
+    """
+    Returns a highest scoring ordering of word_bag under model, which
+    most_likely_sequence only approximates, by A* search over states of
+    (last n - 1 words, words left). The score of every n-gram comes from
+    score_table (batch_model is passed on to it).
+
+    The bound on the score still to come gives each word left the best
+    score of an n-gram ending in it whose next to last word is the last
+    word so far or another word left. It never underestimates, so the
+    first complete ordering taken off the queue is optimal. States are
+    queued with a looser bound, the best score of any n-gram ending in
+    each word left, and get the tighter one when first taken off.
+
+    Paths through an n-gram scored -inf are dropped. If every ordering
+    has one, they're all equally unlikely, and word_bag is returned as
+    is.
+    """
+    counts = Counter(word_bag)
+    words = list(counts)
+    k = len(words)
+    table = score_table(words, model, n, batch_model)
+    radix = k + 1
+    num_histories = radix ** (n - 1)
+    best = [max(table[row * k + w] for row in range(num_histories))
+            for w in range(k)]
+    if -math.inf in best:
+        return list(word_bag) # some word can't be used anywhere
+    # best_after[v][w] is the best score of an n-gram ending in v, w
+    # (v = k being the start token)
+    if n == 1:
+        best_after = [best] * radix
+    else:
+        best_after = [[-math.inf] * k for v in range(radix)]
+        for row in range(num_histories):
+            v_best = best_after[row % radix]
+            for w in range(k):
+                v_best[w] = max(v_best[w], table[row * k + w])
+    remaining, weights = _remaining_counts(counts.values())
+    radixes = [count + 1 for count in counts.values()]
+
+    def tight_bound(history, remaining):
+        left = [(w, remaining // weight % r)
+                for w, (weight, r) in enumerate(zip(weights, radixes))
+                if remaining // weight % r]
+        befores = [best_after[history % radix]]
+        befores.extend(best_after[w] for w, count in left)
+        return sum(count * max(before[w] for before in befores)
+                   for w, count in left)
+
+    history = 0 # row of the last n - 1 word indexes in table
+    for i in range(n - 1):
+        history = history * radix + k
+    # entries are (-(log_p + bound), tie breaker, tight, log_p, bound,
+    # history, remaining, path), bound being the loose one and path a
+    # linked list (w, path) of the words used, last first
+    bound = sum(count * b for count, b in zip(counts.values(), best))
+    queue = [(-bound, 0, False, 0.0, bound, history, remaining, None)]
+    best_log_ps = {(history, remaining): 0.0}
+    pushed = 1
+    while len(queue) > 0:
+        entry = heapq.heappop(queue)
+        f, _, tight, log_p, bound, history, remaining, path = entry
+        if remaining == 0:
+            word_sequence = []
+            while path is not None:
+                w, path = path
+                word_sequence.append(words[w])
+            word_sequence.reverse()
+            return word_sequence
+        if log_p < best_log_ps[(history, remaining)]:
+            continue # reached again with a better score since queued
+        if not tight:
+            tight_f = log_p + tight_bound(history, remaining)
+            if tight_f < -f:
+                heapq.heappush(queue, (-tight_f, pushed, True) + entry[3:])
+                pushed += 1
+                continue
+        row = history * k
+        for w, (weight, r) in enumerate(zip(weights, radixes)):
+            if remaining // weight % r:
+                next_log_p = log_p + table[row + w]
+                next_state = ((history * radix + w) % num_histories,
+                              remaining - weight)
+                if next_log_p > best_log_ps.get(next_state, -math.inf):
+                    best_log_ps[next_state] = next_log_p
+                    next_bound = bound - best[w]
+                    # the parent's f bounds its children's too
+                    next_f = min(-f, next_log_p + next_bound)
+                    heapq.heappush(queue, (
+                        -next_f, pushed, False, next_log_p, next_bound,
+                        next_state[0], next_state[1], (w, path)))
+                    pushed += 1
+    return list(word_bag)
+
+def beam_disagreement(word_bags, model, n, beam_width):
+    """
+    Returns the fraction of word_bags for which most_likely_sequence with
+    beam_width returns a different sequence than without a beam.
+    """
+    differences = sum(
+        most_likely_sequence(word_bag, model, n, beam_width)
+        != most_likely_sequence(word_bag, model, n)
+        for word_bag in word_bags)
+    return differences / len(word_bags)
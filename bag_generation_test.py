@@ -1,6 +1,6 @@
-import io, sys, random, math
+import io, sys, random, math, itertools
 import unittest
-import ch4, bag_generation, tokenizer
+import ch4, bag_generation, katzbackoff, tokenizer
 
 class BagGenerationTests(unittest.TestCase):
     def test_bigram_model(self):
@@ -45,3 +45,182 @@ class BagGenerationTests(unittest.TestCase):
              "'s", 'horses', 'and', 'all', 'the', 'king', "'s", 'men',
              'could', 'not', 'put', 'humpty', 'together', 'again'],
             seq)
+
+    def _trigram_cond_prob(self, f):
+        model = ch4.compute_n_gram_model(f, 3)
+        cond_probs = dict(model.compute_conditional_probs())
+        def cond_prob(trigram):
+            if trigram in cond_probs:
+                return math.log(cond_probs[trigram].conditional_probability)
+            else:
+                return -sys.maxsize - 1
+        return cond_prob
+
+    def test_beam_width(self):
+        f = io.StringIO(
+            "Humpty Dumpty sat on a wall, "
+            "Humpty Dumpty had a great fall; "
+            "All the king's horses and all the king's men "
+            "Couldn't put Humpty together again.")
+        word_bag = list(tokenizer.tokenize(f))
+        f.seek(0)
+        cond_prob = self._trigram_cond_prob(f)
+        exact = bag_generation.most_likely_sequence(word_bag, cond_prob, 3)
+        self.assertEqual(
+            exact,
+            bag_generation.most_likely_sequence(word_bag, cond_prob, 3, 1000))
+        narrow = bag_generation.most_likely_sequence(word_bag, cond_prob, 3, 1)
+        self.assertEqual(sorted(word_bag), sorted(narrow))
+        word_bags = [word_bag[:6], word_bag[6:12], word_bag]
+        self.assertEqual(
+            0.0, bag_generation.beam_disagreement(word_bags, cond_prob, 3, 1000))
+        disagreement = bag_generation.beam_disagreement(word_bags, cond_prob, 3, 1)
+        self.assertTrue(0.0 <= disagreement <= 1.0)
+
+    def test_repeated_words_share_cells(self):
+        n_grams = []
+        def model(n_gram):
+            n_grams.append(n_gram)
+            return -5.0 if n_gram == ("end", "the") or n_gram[0] == "<s>" else -1.0
+        seq = bag_generation.most_likely_sequence(["the"] * 8 + ["end"], model, 2)
+        self.assertEqual(["the"] * 8 + ["end"], seq)
+        # copies of "the" are used in order, so each layer has at most two
+        # cells, each expanded by at most two distinct words
+        self.assertLessEqual(len(n_grams), 4 * 9)
+
+    def _position_search(self, word_bag, model, n):
+        """
+        most_likely_sequence keyed by bag positions rather than slots, as
+        it was before repeated words were merged.
+        """
+        start = len(word_bag)
+        words = list(word_bag) + [tokenizer.START]
+        layer = { (start,) * (n - 1): (0.0, 0, None) } # n-1 gram -> (log_p, used, parent)
+        for i in range(len(word_bag)):
+            next_layer = {}
+            for position in range(len(word_bag)):
+                for n_1_gram, cell in layer.items():
+                    log_p, used, parent = cell
+                    if not used & (1 << position):
+                        log_p += model(tuple(words[p] for p in n_1_gram + (position,)))
+                        key = n_1_gram[1:] + (position,)
+                        if key not in next_layer or log_p > next_layer[key][0]:
+                            next_layer[key] = (log_p, used | (1 << position), (position, cell))
+            layer = next_layer
+        cell = max(layer.values(), key=lambda cell: cell[0])
+        word_sequence = []
+        while cell[2] is not None:
+            position, cell = cell[2]
+            word_sequence.append(words[position])
+        word_sequence.reverse()
+        return word_sequence
+
+    def test_position_search_regression(self):
+        text = ("Humpty Dumpty sat on a wall, "
+                "Humpty Dumpty had a great fall; "
+                "All the king's horses and all the king's men "
+                "Couldn't put Humpty together again.")
+        words = list(tokenizer.tokenize(io.StringIO(text)))
+        distinct = list(dict.fromkeys(words))
+        rng = random.Random(0)
+        for n in [2, 3]:
+            model = katzbackoff.LanguageModel(katzbackoff.compute_model(
+                katzbackoff.populate_trie_nodes(io.StringIO(text), n), n), n)
+            def score(word_sequence):
+                padded = [tokenizer.START] * (n - 1) + word_sequence
+                return sum(model.log_p_katz(tuple(padded[i:i + n]))
+                           for i in range(len(word_sequence)))
+            # without repeated words the searches are the same
+            for i in range(20):
+                word_bag = rng.sample(distinct, rng.randint(2, 8))
+                self.assertEqual(
+                    self._position_search(word_bag, model.log_p_katz, n),
+                    bag_generation.most_likely_sequence(word_bag, model.log_p_katz, n))
+            # with them, results can differ either way, but not for the
+            # worse overall
+            total = expected_total = 0.0
+            for i in range(40):
+                word_bag = rng.sample(words, rng.randint(4, 10))
+                word_sequence = bag_generation.most_likely_sequence(
+                    word_bag, model.log_p_katz, n)
+                self.assertEqual(sorted(word_bag), sorted(word_sequence))
+                total += score(word_sequence)
+                expected_total += score(
+                    self._position_search(word_bag, model.log_p_katz, n))
+            self.assertGreaterEqual(total, expected_total - 1e-9)
+
+    def test_score_table(self):
+        words = ["humpty", "dumpty", "sat"]
+        table = bag_generation.score_table(words, lambda n_gram: len(" ".join(n_gram)), 3)
+        self.assertEqual(4 * 4 * 3, len(table))
+        # (<s>, humpty, sat)
+        self.assertEqual(len("<s> humpty sat"), table[(3 * 4 + 0) * 3 + 2])
+        # (humpty, <s>, sat) can't happen
+        self.assertEqual(-math.inf, table[(0 * 4 + 3) * 3 + 2])
+
+    def test_score_table_search(self):
+        text = ("Humpty Dumpty sat on a wall, "
+                "Humpty Dumpty had a great fall; "
+                "All the king's horses and all the king's men "
+                "Couldn't put Humpty together again.")
+        word_bag = list(tokenizer.tokenize(io.StringIO(text)))
+        random.Random(0).shuffle(word_bag)
+        for n in (1, 3):
+            model = katzbackoff.LanguageModel(katzbackoff.compute_model(
+                katzbackoff.populate_trie_nodes(io.StringIO(text), n), n), n)
+            expected = bag_generation.most_likely_sequence(word_bag, model.log_p_katz, n)
+            self.assertEqual(
+                expected,
+                bag_generation.most_likely_sequence(
+                    word_bag, model.log_p_katz, n, use_score_table=True))
+            self.assertEqual(
+                expected,
+                bag_generation.most_likely_sequence(
+                    word_bag, model.log_p_katz, n,
+                    batch_model=model.log_p_katz_batch))
+
+    def test_exact_most_likely_sequence(self):
+        text = ("Humpty Dumpty sat on a wall, "
+                "Humpty Dumpty had a great fall; "
+                "All the king's horses and all the king's men "
+                "Couldn't put Humpty together again.")
+        words = list(tokenizer.tokenize(io.StringIO(text)))
+        rng = random.Random(0)
+        for n in [2, 3]:
+            model = katzbackoff.LanguageModel(katzbackoff.compute_model(
+                katzbackoff.populate_trie_nodes(io.StringIO(text), n), n), n)
+            def score(word_sequence):
+                padded = [tokenizer.START] * (n - 1) + list(word_sequence)
+                return sum(model.log_p_katz(tuple(padded[i:i + n]))
+                           for i in range(len(word_sequence)))
+            for i in range(10):
+                word_bag = rng.sample(words, 6)
+                best = max(map(score, itertools.permutations(word_bag)))
+                word_sequence = bag_generation.exact_most_likely_sequence(
+                    word_bag, model.log_p_katz, n)
+                self.assertEqual(sorted(word_bag), sorted(word_sequence))
+                self.assertAlmostEqual(best, score(word_sequence))
+            word_bag = words[:12]
+            word_sequence = bag_generation.exact_most_likely_sequence(
+                word_bag, model.log_p_katz, n, batch_model=model.log_p_katz_batch)
+            self.assertEqual(sorted(word_bag), sorted(word_sequence))
+            self.assertGreaterEqual(
+                score(word_sequence) + 1e-9,
+                score(bag_generation.most_likely_sequence(
+                    word_bag, model.log_p_katz, n)))
+
+    def test_exact_most_likely_sequence_impossible(self):
+        def model(n_gram):
+            # "b" can only follow "a", and "c" can't follow anything
+            if n_gram[-1] == "b" and n_gram[-2] != "a":
+                return -math.inf
+            if n_gram[-1] == "c" and n_gram[-2] != tokenizer.START:
+                return -math.inf
+            return math.log(0.5)
+        self.assertEqual(
+            ["a", "b", "a"],
+            bag_generation.exact_most_likely_sequence(["b", "a", "a"], model, 2))
+        for word_bag in [["b", "c"], ["b", "b", "a"], ["c", "c", "a"]]:
+            self.assertEqual(
+                word_bag,
+                bag_generation.exact_most_likely_sequence(word_bag, model, 2))
@@ -1,6 +1,10 @@
-from tokenizer import tokenize, detokenize
+from tokenizer import tokenize, detokenize, corpus_files, \
+    parallel_map, parallel_tokenize_files, START
 import pprint
-import os, math, random
+import math, random, heapq, operator
+from bisect import bisect_right
+from collections import Counter
+from itertools import accumulate, islice
 
 class CircularBuffer(object):
     def __init__(self, capacity):
@@ -80,14 +84,31 @@ class SimpleGoodTuringCountSmoother(object):
     def __call__(self, r):
         return r * math.pow((1 + 1/r), self.b + 1)
 
+def _make_sampling_table(count_map):
+    """
+    Returns (tokens, cumulative_counts) for count_map of token -> count.
+    """
+    return list(count_map.keys()), list(accumulate(count_map.values()))
+
+def _sample(sampling_table, rng):
+    tokens, cumulative_counts = sampling_table
+    return tokens[bisect_right(
+        cumulative_counts, rng.randrange(cumulative_counts[-1]))]
+
+def _num_unseen(items, counts):
+    """
+    Returns the number of distinct items whose count is None.
+    """
+    return len(set(item for item, count in zip(items, counts) if count is None))
+
 class ConditionalCounts(object):
     def __init__(self):
         self.count = 0
         self.counts = {}
 
-    def add_count(self, token):
-        self.count += 1
-        self.counts[token] = self.counts.get(token, 0) + 1
+    def add_count(self, token, count=1):
+        self.count += count
+        self.counts[token] = self.counts.get(token, 0) + count
 
 class Probability(object):
     def __init__(self, count, total_count, sgt_smoothed_probability):
@@ -123,14 +144,28 @@ class ConditionalProbability(object):
         return str(self)
 
 class LanguageModel(object):
-    def __init__(self, n):
+    def __init__(self, n, vocabulary=None):
+        """
+        If vocabulary is given, n-grams are tuples of its integer ids
+        rather than of token strings.
+        """
         self.n = n
+        self.vocabulary = vocabulary
+        self.start = START if vocabulary is None else vocabulary.start_id
         # conditional_counts is a mapping from n-1 gram to ConditionalCounts.
         self.conditional_counts = {} if n > 1 else None
         # counts is a mapping from n-gram to count.
         self.counts = {}
+        # _sampling_tables is a mapping from n-1 gram to the sampling
+        # table for its next token, plus None to the table for start
+        # n-1 grams. Built lazily, dropped whenever counts change.
+        self._sampling_tables = None
+        # _estimates caches the total count and SGT fits, see _estimate.
+        self._estimates = None
 
     def add_n_gram(self, n_gram):
+        self._sampling_tables = None
+        self._estimates = None
         self.counts[n_gram] = self.counts.get(n_gram, 0) + 1
         if self.n > 1:
             n_1_gram = n_gram[:-1]
@@ -138,29 +173,193 @@ class LanguageModel(object):
                 self.conditional_counts[n_1_gram] = ConditionalCounts()
             self.conditional_counts[n_1_gram].add_count(n_gram[-1])
 
+    def add_n_gram_counts(self, n_gram_counts):
+        """
+        Same as calling add_n_gram count times for each n_gram -> count
+        in n_gram_counts, but with one update per distinct n-gram.
+        """
+        self._sampling_tables = None
+        self._estimates = None
+        for n_gram, count in n_gram_counts.items():
+            self.counts[n_gram] = self.counts.get(n_gram, 0) + count
+            if self.n > 1:
+                n_1_gram = n_gram[:-1]
+                if n_1_gram not in self.conditional_counts:
+                    self.conditional_counts[n_1_gram] = ConditionalCounts()
+                self.conditional_counts[n_1_gram].add_count(n_gram[-1], count)
+
+    def merge(self, other):
+        """
+        Adds the counts of LanguageModel other into this one and returns
+        this model. other may use a different vocabulary, or none.
+        """
+        if other.n != self.n:
+            raise ValueError("can't merge a {}-gram model into a {}-gram model".format(
+                other.n, self.n))
+        self.add_n_gram_counts(
+            self._convert_n_gram_counts(other.counts, other.vocabulary))
+        return self
+
+    def _convert_n_gram_counts(self, n_gram_counts, vocabulary):
+        """
+        Maps n_gram_counts, keyed by ids of vocabulary (or by strings if
+        vocabulary is None), to this model's keys.
+        """
+        if vocabulary is self.vocabulary:
+            return n_gram_counts
+        converted = Counter()
+        for n_gram, count in n_gram_counts.items():
+            if vocabulary is not None:
+                n_gram = vocabulary.to_tokens(n_gram)
+            if self.vocabulary is not None:
+                n_gram = self.vocabulary.to_ids(n_gram)
+            converted[tuple(n_gram)] += count
+        return converted
+
+    def _estimate(self, name):
+        """
+        Returns the named estimate ("total_count", "n_sgt", "n_1_sgt",
+        "log_n_sgt" or "log_n_1_sgt"), computing it only once per change
+        to the counts.
+        """
+        if self._estimates is None:
+            self._estimates = {}
+        if name not in self._estimates:
+            if name == "total_count":
+                estimate = sum(self.counts.values())
+            elif name == "n_sgt":
+                estimate = simple_good_turing_estimates(
+                    self.n_gram_count_frequencies())
+            elif name == "n_1_sgt":
+                estimate = simple_good_turing_estimates(
+                    self.n_1_gram_count_frequencies())
+            else:
+                estimate = { r: math.log(p_r) for r, p_r
+                             in self._estimate(name[len("log_"):]).items() }
+            self._estimates[name] = estimate
+        return self._estimates[name]
+
+    def _probability(self, count):
+        return Probability(
+            count, self._estimate("total_count"), self._estimate("n_sgt")[count])
+
+    def _conditional_probability(self, count, condition_count):
+        return ConditionalProbability(
+            count, condition_count, self._estimate("n_sgt")[count],
+            self._estimate("n_1_sgt")[condition_count])
+
+    def probability(self, n_gram):
+        """
+        Returns the Probability of n_gram, or None if it was never seen.
+        """
+        count = self.counts.get(n_gram, None)
+        return None if count is None else self._probability(count)
+
+    def conditional_probability(self, n_gram):
+        """
+        Returns the ConditionalProbability of n_gram's last token given
+        the rest, or None if n_gram was never seen.
+        """
+        cond_count = self.conditional_counts.get(n_gram[:-1], None)
+        if cond_count is None:
+            return None
+        count = cond_count.counts.get(n_gram[-1], None)
+        if count is None:
+            return None
+        return self._conditional_probability(count, cond_count.count)
+
+    def top_probabilities(self, k):
+        """
+        Same as compute_probabilities()[:k], but only builds Probability
+        objects for the k winners of a heap selection.
+        """
+        top = heapq.nlargest(k, self.counts.items(), key=lambda x: x[1])
+        return [[n_gram, self._probability(count)] for n_gram, count in top]
+
+    def top_conditional_probs(self, k):
+        """
+        Same as compute_conditional_probs()[:k], but only builds
+        ConditionalProbability objects for the k winners of a heap
+        selection.
+        """
+        candidates = ((n_1_gram, token, count, cond_count.count)
+                      for n_1_gram, cond_count in self.conditional_counts.items()
+                      for token, count in cond_count.counts.items())
+        top = heapq.nlargest(k, candidates, key=lambda x: x[2] / x[3])
+        return [[n_1_gram + (token,),
+                 self._conditional_probability(count, condition_count)]
+                for n_1_gram, token, count, condition_count in top]
+
+    def _log_sgt_lookup(self, name, num_unseen):
+        """
+        Returns a dict mapping each count (and None, for unseen) to its
+        log SGT probability, where unseen items split the zero-count mass
+        equally among num_unseen types.
+        """
+        log_sgt = dict(self._estimate(name))
+        if num_unseen > 0:
+            log_sgt[None] = log_sgt[0] - math.log(num_unseen)
+        return log_sgt
+
+    def log_probs(self, n_grams, num_unseen=None):
+        """
+        Returns the SGT-smoothed log probability of each of n_grams, as
+        in Probability.sgt_smoothed_probability. Unseen n-grams share
+        the zero-count mass among num_unseen types, by default the number
+        of distinct unseen n-grams in n_grams.
+        """
+        counts = list(map(self.counts.get, n_grams))
+        if num_unseen is None:
+            num_unseen = _num_unseen(n_grams, counts)
+        return list(map(
+            self._log_sgt_lookup("log_n_sgt", num_unseen).__getitem__, counts))
+
+    def conditional_log_probs(self, n_grams):
+        """
+        Returns the SGT-smoothed log probability of each of n_grams'
+        last token given the rest, as in
+        ConditionalProbability.sgt_conditional_probability. Unseen
+        n-grams and histories share the zero-count mass equally among
+        the distinct unseen ones in n_grams.
+        """
+        n_1_grams = [n_gram[:-1] for n_gram in n_grams]
+        counts = list(map(self.counts.get, n_grams))
+        n_1_counts = [None if cond_count is None else cond_count.count
+                      for cond_count in map(self.conditional_counts.get, n_1_grams)]
+        log_sgt = self._log_sgt_lookup(
+            "log_n_sgt", _num_unseen(n_grams, counts))
+        log_n_1_sgt = self._log_sgt_lookup(
+            "log_n_1_sgt", _num_unseen(n_1_grams, n_1_counts))
+        return list(map(operator.sub,
+                        map(log_sgt.__getitem__, counts),
+                        map(log_n_1_sgt.__getitem__, n_1_counts)))
+
+    def score_tokens(self, tokens):
+        """
+        Returns the log probability of each token in tokens (ids if the
+        model has a vocabulary) given its n-1 predecessors, padding the
+        start as when counting.
+        """
+        n_grams = list(_n_gram_windows(tokens, self.n, self.start))
+        if self.n == 1:
+            return self.log_probs(n_grams)
+        return self.conditional_log_probs(n_grams)
+
+    def perplexity(self, tokens):
+        log_probs = self.score_tokens(tokens)
+        return math.exp(-math.fsum(log_probs) / len(log_probs))
+
     def compute_probabilities(self):
-        total_count = sum(v for k, v in self.counts.items())
-        sgt_estimates = simple_good_turing_estimates(
-            self.n_gram_count_frequencies())
-        probs = [[k, Probability(v, total_count, sgt_estimates[v])]
-                  for k, v in self.counts.items()]
+        probs = [[k, self._probability(v)] for k, v in self.counts.items()]
         return sorted(probs, key=lambda x: -x[1].probability)
 
     def compute_conditional_probs(self):
-        n_sgt_estimates = simple_good_turing_estimates(
-            self.n_gram_count_frequencies())
-        n_1_sgt_estimates = simple_good_turing_estimates(
-            self.n_1_gram_count_frequencies())
         cond_probs = []
         for n_1_gram, cond_count in self.conditional_counts.items():
             for token, count in cond_count.counts.items():
                 n_gram = n_1_gram + (token,)
                 cond_probs.append(
-                    [n_gram, ConditionalProbability(
-                        count,
-                        cond_count.count,
-                        n_sgt_estimates[count],
-                        n_1_sgt_estimates[cond_count.count])])
+                    [n_gram, self._conditional_probability(count, cond_count.count)])
         return sorted(cond_probs, key=lambda x: -x[1].conditional_probability)
 
     def n_1_gram_count_frequencies(self):
@@ -175,68 +374,141 @@ class LanguageModel(object):
             gt_counts[count] = gt_counts.get(count, 0) + 1
         return [CountFrequency(r, N_r) for r, N_r in gt_counts.items()]
 
-    def _gen_random(self, count_map):
+    def _sampling_table(self, n_1_gram):
+        if self._sampling_tables is None:
+            self._sampling_tables = {}
+        sampling_table = self._sampling_tables.get(n_1_gram, None)
+        if sampling_table is None:
+            if n_1_gram is None:
+                count_map = { k: cond_count.count
+                              for k, cond_count in self.conditional_counts.items()
+                              if k[0] == self.start }
+            else:
+                count_map = self.conditional_counts[n_1_gram].counts
+            sampling_table = _make_sampling_table(count_map)
+            self._sampling_tables[n_1_gram] = sampling_table
+        return sampling_table
+
+    def _random_start_n_1_gram(self, rng=random):
+        return _sample(self._sampling_table(None), rng)
+
+    def gen_random(self, token_length, rng=random):
         """
-        Given a count_map of token -> count, choose one randomly, 
-        weighted by the count.
+        rng is anything with a randrange method, e.g. a random.Random.
         """
-        seq = [[k, v] for k, v in count_map.items()]
-        cur_index = 0
-        for elem in seq:
-            count = elem[1]
-            elem.extend([cur_index, cur_index + count])
-            cur_index += count
-        total_count = cur_index
-        rand_index = random.randrange(total_count)
-        return next(
-            elem[0] for elem in seq if
-            elem[2] <= rand_index and rand_index < elem[3])
-
-    def _random_start_n_1_gram(self):
-        count_map = { k: self.conditional_counts[k].count
-                      for k in self.conditional_counts.keys()
-                      if k[0] == '<s>' }
-        return self._gen_random(count_map)
-
-    def gen_random(self, token_length):
-        cur_n_1_gram = self._random_start_n_1_gram()
+        cur_n_1_gram = self._random_start_n_1_gram(rng)
         tokens = list(cur_n_1_gram)
         while len(tokens) < token_length:
-            cond_count = self.conditional_counts[cur_n_1_gram]
-            token = self._gen_random(cond_count.counts)
+            token = _sample(self._sampling_table(cur_n_1_gram), rng)
             tokens.append(token)
             n_gram = cur_n_1_gram + (token,)
             cur_n_1_gram = n_gram[1:]
+        if self.vocabulary is not None:
+            return self.vocabulary.to_tokens(tokens)
         return tokens
 
-def compute_n_gram_model(f, n, model=None, include_punctuation=False):
+    def gen_random_batch(self, num_sequences, token_length, seed=None):
+        """
+        Returns num_sequences lists of token_length tokens, drawn with a
+        random.Random(seed) so that a batch can be reproduced.
+        """
+        rng = random.Random(seed)
+        return [self.gen_random(token_length, rng) for i in range(num_sequences)]
+
+def compute_n_gram_model(f, n, model=None, include_punctuation=False,
+                         vocabulary=None):
     """
     Returns a LanguageModel for text in file f.
     """
+    if model is None:
+        model = LanguageModel(n, vocabulary)
+    tokens = tokenize(f, include_punctuation=include_punctuation)
+    if model.vocabulary is not None:
+        tokens = model.vocabulary.to_ids(tokens)
+    return compute_n_gram_model_from_tokens(tokens, n, model)
+
+def compute_n_gram_model_from_tokens(tokens, n, model=None):
+    """
+    tokens are ids if model has a vocabulary.
+    """
     if model is None:
         model = LanguageModel(n)
     circ_buff = CircularBuffer(n)
     for i in range(n - 1):
-        circ_buff.add("<s>")
-    for token in tokenize(f, include_punctuation=include_punctuation):
+        circ_buff.add(model.start)
+    for token in tokens:
         circ_buff.add(token)
         if len(circ_buff) == n:
             model.add_n_gram(circ_buff.make_snapshot_tuple())
     return model
 
-def compute_n_gram_model_for_file(fn, n, include_punctuation=False):
+def _n_gram_windows(tokens, n, start=START):
+    """
+    Returns an iterator over the n-grams compute_n_gram_model_from_tokens
+    would add for tokens: zipped offset views of one padded list, so
+    there's no per-token Python code.
+    """
+    padded = [start] * (n - 1)
+    padded.extend(tokens)
+    return zip(*(islice(padded, i, None) for i in range(n)))
+
+def count_n_grams(tokens, n, start=START):
+    """
+    Returns a Counter of the n-grams compute_n_gram_model_from_tokens
+    would add for tokens, counted in a single Counter pass.
+    """
+    return Counter(_n_gram_windows(tokens, n, start))
+
+def compute_n_gram_model_bulk(tokens, n, model=None):
+    """
+    Like compute_n_gram_model_from_tokens, but counts all of tokens in
+    one batch; tokens must fit in memory.
+    """
+    if model is None:
+        model = LanguageModel(n)
+    model.add_n_gram_counts(count_n_grams(tokens, n, model.start))
+    return model
+
+def compute_n_gram_model_for_file(fn, n, include_punctuation=False,
+                                  vocabulary=None):
     with open(fn, 'r') as f:
         return compute_n_gram_model(
-            f, n, include_punctuation=include_punctuation)
-
-def compute_n_gram_model_for_dir(dir_name, n, include_punctuation=False):
-    model = LanguageModel(n)
-    for fn in os.listdir(dir_name):
-        if fn == '.DS_Store':
-            continue
-        full_fn = os.path.join(dir_name, fn)
-        with open(full_fn, 'r') as f:
-            compute_n_gram_model(f, n, model, include_punctuation)
+            f, n, include_punctuation=include_punctuation,
+            vocabulary=vocabulary)
+
+def _count_file_n_grams(args):
+    fn, n, include_punctuation = args
+    with open(fn, 'r') as f:
+        return count_n_grams(tokenize(f, include_punctuation), n)
+
+def compute_n_gram_model_for_dir(dir_name, n, include_punctuation=False,
+                                 processes=1, vocabulary=None,
+                                 count_in_workers=False):
+    """
+    processes is the number of worker processes; None uses every core.
+    By default workers only tokenize (splitting large files into shards);
+    with count_in_workers each file is tokenized and counted in its own
+    worker (or in turn here, if processes is 1) and the per-file counts
+    are merged here.
+    """
+    model = LanguageModel(n, vocabulary)
+    if count_in_workers:
+        for n_gram_counts in parallel_map(
+                _count_file_n_grams,
+                [(fn, n, include_punctuation) for fn in corpus_files(dir_name)],
+                processes):
+            model.add_n_gram_counts(
+                model._convert_n_gram_counts(n_gram_counts, None))
+    elif processes == 1:
+        for full_fn in corpus_files(dir_name):
+            with open(full_fn, 'r') as f:
+                compute_n_gram_model(f, n, model, include_punctuation)
+    else:
+        for fn, tokens in parallel_tokenize_files(
+                corpus_files(dir_name), include_punctuation, processes):
+            if vocabulary is not None:
+                tokens = vocabulary.to_ids(tokens)
+            compute_n_gram_model_from_tokens(tokens, n, model)
     return model
 
 def ex_4_3():
@@ -250,18 +522,14 @@ def ex_4_3():
         republic_uni_model = compute_n_gram_model(f, 1)
         f.seek(0)
         republic_bi_model = compute_n_gram_model(f, 2)
-    republic_uni_probs = republic_uni_model.compute_probabilities()
-    inaugural_uni_probs = inaugural_uni_model.compute_probabilities()
     print("Top unis from Republic:")
-    pprint.pprint(republic_uni_probs[:100])
+    pprint.pprint(republic_uni_model.top_probabilities(100))
     print("Top unis from inaugural:")
-    pprint.pprint(inaugural_uni_probs[:100])
-    republic_bi_probs = republic_bi_model.compute_conditional_probs()
-    inaugural_bi_probs = inaugural_bi_model.compute_conditional_probs()
+    pprint.pprint(inaugural_uni_model.top_probabilities(100))
     print("Top bis from Republic:")
-    pprint.pprint(republic_bi_probs[:50])
+    pprint.pprint(republic_bi_model.top_conditional_probs(50))
     print("Top bis from Inaugural:")
-    pprint.pprint(inaugural_bi_probs[:50])
+    pprint.pprint(inaugural_bi_model.top_conditional_probs(50))
 
 def ex_4_4():
     inaugural_n_model = compute_n_gram_model_for_dir(
@@ -291,28 +559,19 @@ def illustrate_simple_good_turing_smoothing():
 def ex_4_5():
     model = compute_n_gram_model_for_dir(
         '/Users/tony/Desktop/inaugural', 2)
-    probs = model.compute_probabilities()
-    pprint.pprint(probs[:10])
-    cond_probs = model.compute_conditional_probs()
-    pprint.pprint(cond_probs[:10])
+    pprint.pprint(model.top_probabilities(10))
+    pprint.pprint(model.top_conditional_probs(10))
 
 def _singleton_unigram_probs_with_smoothing(ref_model, test_model):
     none_tokens = [k for k in test_model.counts.keys() if k not in ref_model.counts]
     singletons = [k for k, v in test_model.counts.items() if v == 1]
-    gt_estimates = simple_good_turing_estimates(
-        ref_model.n_gram_count_frequencies())
+    gt_estimates = ref_model._estimate("n_sgt")
     zero_prob = gt_estimates[0] / len(none_tokens)
     # this model will arguably overestimate the probability of something seen 0 times.
     print("FYI, zero prob is {0}, whereas prob of something seen once is {1}".format(
         zero_prob, gt_estimates[1]))
-    total_log_prob = 0.0
-    for singleton in singletons:
-        count = ref_model.counts.get(singleton, 0)
-        if count > 0:
-            total_log_prob += math.log(gt_estimates[count])
-        else:
-            total_log_prob += math.log(zero_prob)
-    return math.exp(total_log_prob / len(singletons))
+    log_probs = ref_model.log_probs(singletons, num_unseen=len(none_tokens))
+    return math.exp(math.fsum(log_probs) / len(singletons))
 
 def _singleton_unigram_probs_no_smoothing(ref_model, test_model):
     singletons = [k for k, v in test_model.counts.items() if v == 1]
@@ -1,6 +1,6 @@
 import unittest
-import io, math
-import ch4
+import io, math, os, tempfile
+import ch4, tokenizer
 
 class CircularBufferTests(unittest.TestCase):
     def test_tuple(self):
@@ -85,3 +85,157 @@ class LanguageModelTests(unittest.TestCase):
         prob = probs[0][1]
         self.assertAlmostEqual(0.0690, prob.probability, places=4)
         self.assertAlmostEqual(0.0250, prob.sgt_smoothed_probability, places=4)
+
+    def test_parallel_model_for_dir(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            for i, text in enumerate([
+                    "Humpty Dumpty sat on a wall,\nHumpty Dumpty had a great fall;\n",
+                    "All the king's horses and all the king's men\n"
+                    "Couldn't put Humpty together again.\n"]):
+                with open(os.path.join(dir_name, "{}.txt".format(i)), 'w') as f:
+                    f.write(text)
+            model = ch4.compute_n_gram_model_for_dir(dir_name, 2)
+            parallel_model = ch4.compute_n_gram_model_for_dir(
+                dir_name, 2, processes=2)
+            self.assertEqual(model.counts, parallel_model.counts)
+            vocabulary = tokenizer.Vocabulary()
+            map_reduce_model = ch4.compute_n_gram_model_for_dir(
+                dir_name, 2, processes=2, vocabulary=vocabulary,
+                count_in_workers=True)
+            self.assertEqual(
+                model.counts,
+                { tuple(vocabulary.to_tokens(k)): v
+                  for k, v in map_reduce_model.counts.items() })
+            in_process_model = ch4.compute_n_gram_model_for_dir(
+                dir_name, 2, count_in_workers=True)
+            self.assertEqual(model.counts, in_process_model.counts)
+
+    def test_merge(self):
+        texts = ["Humpty Dumpty sat on a wall, Humpty Dumpty had a great fall;",
+                 "All the king's horses and all the king's men "
+                 "Couldn't put Humpty together again."]
+        model = ch4.LanguageModel(2)
+        for text in texts:
+            ch4.compute_n_gram_model(io.StringIO(text), 2, model)
+        merged = ch4.compute_n_gram_model(
+            io.StringIO(texts[0]), 2, vocabulary=tokenizer.Vocabulary())
+        merged.merge(ch4.compute_n_gram_model(io.StringIO(texts[1]), 2))
+        self.assertEqual(
+            model.counts,
+            { tuple(merged.vocabulary.to_tokens(k)): v
+              for k, v in merged.counts.items() })
+        humpty = merged.conditional_counts[(merged.vocabulary.lookup('humpty'),)]
+        self.assertEqual(3, humpty.count)
+        self.assertRaises(ValueError, merged.merge, ch4.LanguageModel(3))
+
+    def test_vocabulary_ids(self):
+        text = ("Humpty Dumpty sat on a wall, "
+                "Humpty Dumpty had a great fall; "
+                "All the king's horses and all the king's men "
+                "Couldn't put Humpty together again.")
+        model = ch4.compute_n_gram_model(io.StringIO(text), 3)
+        vocabulary = tokenizer.Vocabulary()
+        id_model = ch4.compute_n_gram_model(
+            io.StringIO(text), 3, vocabulary=vocabulary)
+        self.assertEqual(
+            model.counts,
+            { tuple(vocabulary.to_tokens(k)): v for k, v in id_model.counts.items() })
+        tokens = id_model.gen_random(10)
+        self.assertEqual(10, len(tokens))
+        self.assertTrue(all(t in vocabulary for t in tokens))
+
+    def test_bulk_counts_match_model(self):
+        text = ("Humpty Dumpty sat on a wall, "
+                "Humpty Dumpty had a great fall; "
+                "All the king's horses and all the king's men "
+                "Couldn't put Humpty together again.")
+        for n in [1, 2, 3]:
+            model = ch4.compute_n_gram_model(io.StringIO(text), n)
+            tokens = list(tokenizer.tokenize(io.StringIO(text)))
+            bulk_model = ch4.compute_n_gram_model_bulk(tokens, n)
+            self.assertEqual(model.counts, bulk_model.counts)
+            if n > 1:
+                self.assertEqual(
+                    { k: (c.count, c.counts) for k, c in model.conditional_counts.items() },
+                    { k: (c.count, c.counts) for k, c in bulk_model.conditional_counts.items() })
+
+    def test_gen_random_batch(self):
+        f = io.StringIO(
+            "Humpty Dumpty sat on a wall, "
+            "Humpty Dumpty had a great fall; "
+            "All the king's horses and all the king's men "
+            "Couldn't put Humpty together again.")
+        model = ch4.compute_n_gram_model(f, 3)
+        batch = model.gen_random_batch(20, 8, seed=1)
+        self.assertEqual(batch, model.gen_random_batch(20, 8, seed=1))
+        self.assertEqual(20, len(batch))
+        for tokens in batch:
+            self.assertEqual(8, len(tokens))
+            for i in range(len(tokens) - 2):
+                self.assertTrue(tuple(tokens[i:i + 3]) in model.counts)
+        # new counts must invalidate the cached sampling tables
+        model.add_n_gram(("<s>", "<s>", "zebra"))
+        model.add_n_gram(("<s>", "zebra", "<s>"))
+        model.add_n_gram(("zebra", "<s>", "<s>"))
+        batch = model.gen_random_batch(200, 3, seed=1)
+        self.assertTrue(["<s>", "<s>", "zebra"] in batch)
+
+    def test_top_k_and_lookups(self):
+        f = io.StringIO(
+            "Humpty Dumpty sat on a wall, "
+            "Humpty Dumpty had a great fall; "
+            "All the king's horses and all the king's men "
+            "Couldn't put Humpty together again.")
+        model = ch4.compute_n_gram_model(f, 2)
+        probs = model.compute_probabilities()
+        top = model.top_probabilities(5)
+        self.assertEqual([p[0] for p in probs[:5]], [p[0] for p in top])
+        self.assertEqual(str(probs[:5]), str(top))
+        cond_probs = model.compute_conditional_probs()
+        top = model.top_conditional_probs(10)
+        self.assertEqual([p[0] for p in cond_probs[:10]], [p[0] for p in top])
+        self.assertEqual(str(cond_probs[:10]), str(top))
+        prob = model.probability(('humpty', 'dumpty'))
+        self.assertEqual(2, prob.count)
+        self.assertAlmostEqual(0.0250, prob.sgt_smoothed_probability, places=4)
+        self.assertIsNone(model.probability(('dumpty', 'humpty')))
+        cond_prob = model.conditional_probability(('humpty', 'together'))
+        self.assertAlmostEqual(0.33333, cond_prob.conditional_probability, places=3)
+        self.assertIsNone(model.conditional_probability(('humpty', 'sat')))
+        self.assertIsNone(model.conditional_probability(('egg', 'sat')))
+        # the cached SGT fit is refit once the counts change
+        model.add_n_gram(('dumpty', 'humpty'))
+        self.assertEqual(1, model.probability(('dumpty', 'humpty')).count)
+        self.assertNotAlmostEqual(
+            0.0250, model.probability(('humpty', 'dumpty')).sgt_smoothed_probability,
+            places=4)
+
+    def test_log_probs_and_perplexity(self):
+        text = ("Humpty Dumpty sat on a wall, "
+                "Humpty Dumpty had a great fall; "
+                "All the king's horses and all the king's men "
+                "Couldn't put Humpty together again.")
+        model = ch4.compute_n_gram_model(io.StringIO(text), 2)
+        probs = dict(model.compute_probabilities())
+        cond_probs = dict(model.compute_conditional_probs())
+        n_grams = [('humpty', 'dumpty'), ('sat', 'on'), ('on', 'humpty'),
+                   ('egg', 'fell'), ('on', 'humpty')]
+        log_probs = model.log_probs(n_grams)
+        for n_gram, log_prob in zip(n_grams[:2], log_probs):
+            self.assertAlmostEqual(
+                math.log(probs[n_gram].sgt_smoothed_probability), log_prob)
+        p_0 = model._estimate("n_sgt")[0]
+        self.assertAlmostEqual(math.log(p_0 / 2), log_probs[2])
+        self.assertEqual(log_probs[2], log_probs[4])
+        cond_log_probs = model.conditional_log_probs(n_grams[:2])
+        for n_gram, log_prob in zip(n_grams[:2], cond_log_probs):
+            self.assertAlmostEqual(
+                math.log(cond_probs[n_gram].sgt_conditional_probability), log_prob)
+        tokens = list(tokenizer.tokenize(io.StringIO(text)))
+        scores = model.score_tokens(tokens)
+        self.assertEqual(len(tokens), len(scores))
+        self.assertAlmostEqual(
+            math.log(cond_probs[('humpty', 'dumpty')].sgt_conditional_probability),
+            scores[1])
+        self.assertAlmostEqual(
+            math.exp(-sum(scores) / len(scores)), model.perplexity(tokens))
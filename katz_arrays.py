@@ -0,0 +1,389 @@
+"""Katz backoff model in flat arrays
+
+A compiled katzbackoff model stored one level per n-gram order instead
+of as KatzTrieNode objects. Level n holds the tokens, counts,
+log_p_stars and log_alphas of every n-gram node, grouped by parent and
+sorted by token within a parent, and the range
+children[n - 1][i]:children[n - 1][i + 1] of level n holds the
+children of node i of level n - 1. A node is just its index in its
+level, so n-gram prefixes, parent pointers and per-node dicts aren't
+stored at all; in place of the trie's suffix links, suffixes[n][i] is
+the index in level n - 1 of the node for node i's n_gram[1:]. quantize can further shrink the log_p_stars and
+log_alphas to 8- or 16-bit codes into per-order codebooks.
+"""
+
+from array import array
+from bisect import bisect_left
+import math, multiprocessing, os
+import katzbackoff, model_file
+from tokenizer import corpus_files, line_aligned_shards, tokenize_shard, \
+    SHARD_BYTES
+
+class QuantizedArray(object):
+    """
+    A read-only sequence of doubles stored as codes into a codebook:
+    self[i] is codebook[codes[i]].
+    """
+    def __init__(self, codes, codebook):
+        self.codes = codes
+        self.codebook = codebook
+
+    @staticmethod
+    def from_values(values, bits):
+        """
+        Quantizes values to 2**bits levels (bits is 1 to 16). The sorted
+        values are cut into bins of roughly equal size, never splitting
+        equal values, and each bin is represented by its mean, so there
+        are more levels where there are more values. A NaN gets its own
+        code.
+        """
+        if not 1 <= bits <= 16:
+            raise ValueError("can't quantize to {} bits".format(bits))
+        codes = array('B' if bits <= 8 else 'H', [0]) * len(values)
+        codebook = array('d')
+        finite = sorted((v, i) for i, v in enumerate(values) if not math.isnan(v))
+        num_bins = (1 << bits) - (1 if len(finite) < len(values) else 0)
+        lo = 0
+        while lo < len(finite):
+            hi = lo + max(1, (len(finite) - lo) // (num_bins - len(codebook)))
+            while hi < len(finite) and finite[hi][0] == finite[hi - 1][0]:
+                hi += 1
+            for v, i in finite[lo:hi]:
+                codes[i] = len(codebook)
+            codebook.append(math.fsum(v for v, i in finite[lo:hi]) / (hi - lo))
+            lo = hi
+        if len(finite) < len(values):
+            for i, v in enumerate(values):
+                if math.isnan(v):
+                    codes[i] = len(codebook)
+            codebook.append(math.nan)
+        return QuantizedArray(codes, codebook)
+
+    def __getitem__(self, i):
+        return self.codebook[self.codes[i]]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def nbytes(self):
+        return (self.codes.itemsize * len(self.codes)
+                + self.codebook.itemsize * len(self.codebook))
+
+def _nbytes(arr):
+    if isinstance(arr, QuantizedArray):
+        return arr.nbytes()
+    return arr.itemsize * len(arr)
+
+class FlatKatzModel(katzbackoff.LanguageModel):
+    """
+    Answers log_p_katz and calc_perplexity like katzbackoff.LanguageModel
+    (over vocabulary ids), but from level arrays. Build one with
+    from_model, or map one from a file written by katzbackoff.save_model
+    with load_model.
+    """
+    def __init__(self, N, vocabulary, root_count, root_log_beta,
+                 discount_exponents, children, tokens, counts, log_p_stars,
+                 log_alphas, suffixes):
+        """
+        children is indexed by parent level 0..N-1; tokens, counts,
+        log_p_stars, log_alphas and suffixes by level 1..N, with None at
+        index 0.
+        """
+        katzbackoff.LanguageModel.__init__(self, None, N, vocabulary)
+        self.root_count = root_count
+        self.root_log_beta = root_log_beta
+        self.discount_exponents = discount_exponents
+        self.children = children
+        self.tokens = tokens
+        self.counts = counts
+        self.log_p_stars = log_p_stars
+        self.log_alphas = log_alphas
+        self.suffixes = suffixes
+
+    @staticmethod
+    def from_arrays(metadata, arrays, vocabulary=None):
+        """
+        Builds a model from katzbackoff.LanguageModel.to_arrays output or
+        the contents of a model file; arrays are used in place.
+        """
+        N = metadata["N"]
+        if vocabulary is None:
+            vocabulary = model_file.read_vocabulary(
+                arrays["vocabulary_offsets"], arrays["vocabulary_blob"])
+        def level_arrays(name):
+            level = [None]
+            for n in range(1, N + 1):
+                key = "{}_{}".format(name, n)
+                if key + "_codes" in arrays:
+                    level.append(QuantizedArray(
+                        arrays[key + "_codes"], arrays[key + "_codebook"]))
+                else:
+                    level.append(arrays[key])
+            return level
+        return FlatKatzModel(
+            N, vocabulary, metadata["root_count"], metadata["root_log_beta"],
+            metadata["discount_exponents"],
+            [arrays["children_{}".format(n)] for n in range(N)],
+            level_arrays("tokens"), level_arrays("counts"),
+            level_arrays("log_p_stars"), level_arrays("log_alphas"),
+            level_arrays("suffixes"))
+
+    @staticmethod
+    def from_model(model):
+        """
+        Flattens katzbackoff.LanguageModel model after compute_model.
+        """
+        metadata, arrays = model.to_arrays()
+        return FlatKatzModel.from_arrays(metadata, arrays, model.vocabulary)
+
+    def to_arrays(self):
+        arrays = {}
+        quantized = False
+        for n in range(1, self.N + 1):
+            arrays["children_{}".format(n - 1)] = self.children[n - 1]
+            arrays["tokens_{}".format(n)] = self.tokens[n]
+            arrays["counts_{}".format(n)] = self.counts[n]
+            arrays["suffixes_{}".format(n)] = self.suffixes[n]
+            for name, arr in [("log_alphas", self.log_alphas[n]),
+                              ("log_p_stars", self.log_p_stars[n])]:
+                key = "{}_{}".format(name, n)
+                if isinstance(arr, QuantizedArray):
+                    quantized = True
+                    arrays[key + "_codes"] = arr.codes
+                    arrays[key + "_codebook"] = arr.codebook
+                else:
+                    arrays[key] = arr
+        arrays["vocabulary_offsets"], arrays["vocabulary_blob"] = \
+            model_file.vocabulary_arrays(self.vocabulary)
+        metadata = {
+            "N": self.N,
+            "root_count": self.root_count,
+            "root_log_beta": self.root_log_beta,
+            "discount_exponents": self.discount_exponents,
+            # katzbackoff.load_model rebuilds from exact log_alphas
+            "quantized": quantized }
+        return metadata, arrays
+
+    def num_nodes(self):
+        return 1 + sum(len(self.tokens[n]) for n in range(1, self.N + 1))
+
+    def nbytes(self):
+        """
+        Returns the size of the level arrays in bytes.
+        """
+        return sum(_nbytes(arr)
+                   for level in (self.children, self.tokens[1:], self.counts[1:],
+                                 self.log_p_stars[1:], self.log_alphas[1:],
+                                 self.suffixes[1:])
+                   for arr in level)
+
+    def _check_root_log_beta(self):
+        if self.root_log_beta is None:
+            raise ValueError("model has no probability mass for unknown tokens")
+
+    def _child(self, n, i, token):
+        """
+        Returns the index in level n + 1 of the child of node i of level n
+        for token, or None.
+        """
+        if token is None: # unknown to the vocabulary
+            return None
+        lo = self.children[n][i]
+        hi = self.children[n][i + 1]
+        tokens = self.tokens[n + 1]
+        j = bisect_left(tokens, token, lo, hi)
+        if j < hi and tokens[j] == token:
+            return j
+        return None
+
+    def _root(self):
+        return 0
+
+    def _log_p_star(self, n, i):
+        return self.log_p_stars[n][i]
+
+    def _log_alpha(self, n, i):
+        return self.log_alphas[n][i]
+
+    def _unknown_log_p(self):
+        self._check_root_log_beta()
+        return self.root_log_beta
+
+    def _find(self, n_gram):
+        """
+        Returns the index of n_gram's node in level len(n_gram), or None.
+        The root is index 0 of level 0.
+        """
+        i = 0
+        for n, token in enumerate(n_gram):
+            i = self._child(n, i, token)
+            if i is None:
+                return None
+        return i
+
+    def log_p_katz(self, n_gram):
+        if self._child(0, 0, n_gram[-1]) is None:
+            self._check_root_log_beta()
+            return self.root_log_beta # degenerate case: w_n not in model
+        n = len(n_gram)
+        parent_i = self._find(n_gram[:-1])
+        i = None if parent_i is None else self._child(n - 1, parent_i, n_gram[-1])
+        if i is not None:
+            return self.log_p_stars[n][i]
+        else:
+            suffix = n_gram[1:]
+            if parent_i is None:
+                return self.log_p_katz(suffix)
+            else:
+                return self.log_alphas[n - 1][parent_i] + self.log_p_katz(suffix)
+
+    def begin_state(self):
+        """
+        As katzbackoff.LanguageModel.begin_state, but a state is the
+        (level, index) pair of the node for the longest suffix of the
+        history that is in the model.
+        """
+        n = 0
+        i = 0
+        while n < self.N - 1:
+            j = self._child(n, i, self.start)
+            if j is None:
+                break
+            n += 1
+            i = j
+        return n, i
+
+    def score(self, state, token):
+        if self._child(0, 0, token) is None:
+            self._check_root_log_beta()
+            return self.root_log_beta, (0, 0) # degenerate case: token not in model
+        n, i = state
+        log_alpha = 0.0
+        j = self._child(n, i, token)
+        while j is None:
+            log_alpha += self.log_alphas[n][i]
+            i = self.suffixes[n][i]
+            n -= 1
+            j = self._child(n, i, token)
+        n += 1
+        log_p = log_alpha + self.log_p_stars[n][j]
+        if n == self.N:
+            j = self.suffixes[n][j]
+            n -= 1
+        return log_p, (n, j)
+
+class QuantizationReport(object):
+    def __init__(self, nbytes_before, nbytes_after,
+                 perplexity_before=None, perplexity_after=None):
+        self.nbytes_before = nbytes_before
+        self.nbytes_after = nbytes_after
+        self.perplexity_before = perplexity_before
+        self.perplexity_after = perplexity_after
+
+    def __str__(self):
+        s = "bytes: {} -> {}".format(self.nbytes_before, self.nbytes_after)
+        if self.perplexity_before is not None:
+            s += ", perplexity: {:.4f} -> {:.4f} ({:+.4%})".format(
+                self.perplexity_before, self.perplexity_after,
+                self.perplexity_after / self.perplexity_before - 1)
+        return s
+
+    def __repr__(self):
+        return str(self)
+
+def quantize(model, bits=8, tokens=None):
+    """
+    Replaces the log_p_stars and log_alphas of FlatKatzModel model, in
+    place, with QuantizedArrays using a codebook of 2**bits values per
+    order. Counts, tokens and the root's log_beta are kept exact.
+
+    Returns a QuantizationReport; if tokens (a sequence, scored twice)
+    is given, it includes the model's perplexity on them before and
+    after.
+    """
+    report = QuantizationReport(model.nbytes(), None)
+    if tokens is not None:
+        report.perplexity_before = model.calc_perplexity(tokens)
+    for n in range(1, model.N + 1):
+        model.log_p_stars[n] = QuantizedArray.from_values(model.log_p_stars[n], bits)
+        model.log_alphas[n] = QuantizedArray.from_values(model.log_alphas[n], bits)
+    report.nbytes_after = model.nbytes()
+    if tokens is not None:
+        report.perplexity_after = model.calc_perplexity(tokens)
+    return report
+
+def load_model(fn):
+    """
+    Maps a file written by katzbackoff.save_model as a FlatKatzModel;
+    the level arrays are read straight from the mapped pages.
+    """
+    metadata, arrays = model_file.read(fn, "katz")
+    return FlatKatzModel.from_arrays(metadata, arrays)
+
+_worker_model = None # the model each parallel_perplexity worker maps once
+
+def _load_worker_model(fn):
+    global _worker_model
+    _worker_model = load_model(fn)
+
+def _score_shard(shard):
+    """
+    Scores the tokens of shard as if it started a file. Returns the file
+    index, the sum and number of log probabilities, the first N - 1
+    token ids and their log probabilities (wrong unless the shard does
+    start its file) and the last N - 1 token ids.
+    """
+    file_index, fn, start, end, include_punctuation = shard
+    tokens = tokenize_shard(fn, start, end, include_punctuation)
+    model = _worker_model
+    ids = list(model.vocabulary.lookup_ids(tokens))
+    log_ps = list(model.score_tokens(ids))
+    head = ids[:model.N - 1]
+    return (file_index, math.fsum(log_ps), len(ids), head, log_ps[:len(head)],
+            ids[len(ids) - (model.N - 1):])
+
+def parallel_perplexity(model_fn, path, include_punctuation=False,
+                        processes=None, shard_bytes=SHARD_BYTES):
+    """
+    Returns the perplexity of the model saved (by katzbackoff.save_model)
+    in model_fn on the file or directory path, each file scored from
+    the start state as calc_perplexity would. Files are split into
+    line-aligned shards scored by a pool of processes (None means one
+    per core), each mapping model_fn once, so they share its pages. A
+    shard's first N - 1 tokens are rescored here with the end of the
+    shard before it as history, so the result doesn't depend on
+    how the corpus was sharded.
+    """
+    filenames = corpus_files(path) if os.path.isdir(path) else [path]
+    shards = [(i, fn, start, end, include_punctuation)
+              for i, fn in enumerate(filenames)
+              for start, end in line_aligned_shards(fn, shard_bytes)]
+    model = load_model(model_fn)
+    context_length = model.N - 1
+    log_ps = []
+    token_count = 0
+    def combine(results):
+        nonlocal token_count
+        prev_file_index = None
+        history = None
+        for file_index, sum_log_p, count, head, head_log_ps, tail in results:
+            log_ps.append(sum_log_p)
+            token_count += count
+            if file_index != prev_file_index:
+                history = [model.start] * context_length
+                prev_file_index = file_index
+            for token, shard_log_p in zip(head, head_log_ps):
+                n_gram = tuple(history[len(history) - context_length:]) + (token,)
+                log_ps.append(model.log_p_katz(n_gram) - shard_log_p)
+                history.append(token)
+            if count > len(head):
+                history = tail
+            history = history[len(history) - context_length:]
+    if processes == 1:
+        _load_worker_model(model_fn)
+        combine(map(_score_shard, shards))
+    else:
+        with multiprocessing.Pool(
+                processes, _load_worker_model, (model_fn,)) as pool:
+            combine(pool.imap(_score_shard, shards))
+    return math.exp(-math.fsum(log_ps) / token_count)
@@ -0,0 +1,175 @@
+import unittest
+import io, itertools, math, os, tempfile
+from array import array
+import katzbackoff, katz_arrays, tokenizer
+
+TEXT = ("Humpty Dumpty sat on a wall, "
+        "Humpty Dumpty had a great fall; "
+        "All the king's horses and all the king's men "
+        "Couldn't put Dumpty together again.")
+
+class FlatKatzModelTests(unittest.TestCase):
+    def setUp(self):
+        self.vocabulary = tokenizer.Vocabulary()
+        trie_node = katzbackoff.populate_trie_nodes(
+            io.StringIO(TEXT), 3, vocabulary=self.vocabulary)
+        self.model = katzbackoff.LanguageModel(
+            katzbackoff.compute_model(trie_node, 3, self.vocabulary.start_id),
+            3, self.vocabulary)
+        self.flat_model = katz_arrays.FlatKatzModel.from_model(self.model)
+
+    def _n_grams(self):
+        ids = list(range(len(self.vocabulary))) + [None]
+        return itertools.product(ids, repeat=3)
+
+    def test_log_p_katz(self):
+        for n_gram in self._n_grams():
+            self.assertAlmostEqual(
+                self.model.log_p_katz(n_gram), self.flat_model.log_p_katz(n_gram))
+
+    def test_string_keyed_model(self):
+        # "1990" and "'s" sort before "<s>", which is always id 0
+        text = TEXT + " In 1990 the king's men put him back up."
+        model = katzbackoff.LanguageModel(katzbackoff.compute_model(
+            katzbackoff.populate_trie_nodes(io.StringIO(text), 3), 3), 3)
+        flat_model = katz_arrays.FlatKatzModel.from_model(model)
+        tokens = list(model.trie_node.descendants) + ["stood"]
+        for n_gram in itertools.product(tokens, repeat=3):
+            self.assertAlmostEqual(
+                model.log_p_katz(n_gram),
+                flat_model.log_p_katz(tuple(flat_model.vocabulary.lookup_ids(n_gram))))
+
+    def test_pruned_model(self):
+        katzbackoff.prune(self.model, threshold=1.0)
+        flat_model = katz_arrays.FlatKatzModel.from_model(self.model)
+        with tempfile.TemporaryDirectory() as dir_name:
+            fn = os.path.join(dir_name, "katz.model")
+            katzbackoff.save_model(flat_model, fn)
+            loaded = katz_arrays.load_model(fn)
+            self.assertEqual(self.model.num_nodes(), loaded.num_nodes())
+            for n_gram in self._n_grams():
+                self.assertAlmostEqual(
+                    self.model.log_p_katz(n_gram), loaded.log_p_katz(n_gram))
+            ids = list(self.vocabulary.lookup_ids(
+                "all the king 's horses sat on humpty dumpty again".split()))
+            for log_p, score in zip(self.model.score_tokens(ids),
+                                    loaded.score_tokens(ids)):
+                self.assertAlmostEqual(log_p, score)
+
+    def test_perplexity(self):
+        held_out = ["humpty", "dumpty", "stood", "on", "a", "wall", "again"]
+        self.assertAlmostEqual(
+            self.model.calc_perplexity(self.vocabulary.lookup_ids(held_out)),
+            self.flat_model.calc_perplexity(self.vocabulary.lookup_ids(held_out)))
+
+    def test_load_model(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            fn = os.path.join(dir_name, "katz.model")
+            katzbackoff.save_model(self.flat_model, fn)
+            loaded = katz_arrays.load_model(fn)
+            self.assertEqual(self.flat_model.num_nodes(), loaded.num_nodes())
+            self.assertEqual(self.flat_model.nbytes(), loaded.nbytes())
+            self.assertEqual(self.vocabulary.tokens, loaded.vocabulary.tokens)
+            for n_gram in self._n_grams():
+                self.assertAlmostEqual(
+                    self.model.log_p_katz(n_gram), loaded.log_p_katz(n_gram))
+
+    def test_score_tokens(self):
+        held_out = ("humpty dumpty stood on a wall , all the king 's men "
+                    "and humpty dumpty sat together again").split()
+        ids = list(self.vocabulary.lookup_ids(held_out))
+        expected = []
+        history = [self.vocabulary.start_id] * 2
+        for token in ids:
+            history.append(token)
+            expected.append(self.model.log_p_katz(tuple(history[-3:])))
+        for model in [self.model, self.flat_model]:
+            scores = list(model.score_tokens(ids))
+            self.assertEqual(len(expected), len(scores))
+            for log_p, score in zip(expected, scores):
+                self.assertAlmostEqual(log_p, score)
+
+    def test_quantized_array(self):
+        values = [0.0, -1.5, 0.0, float('nan'), -3.0, -1.5]
+        quantized = katz_arrays.QuantizedArray.from_values(values, 2)
+        self.assertEqual(values[:3], [quantized[i] for i in range(3)])
+        self.assertNotEqual(quantized[3], quantized[3]) # NaN
+        self.assertEqual(values[4:], [quantized[i] for i in range(4, 6)])
+        quantized = katz_arrays.QuantizedArray.from_values([1.0, 2.0, 4.0, 5.0], 1)
+        self.assertEqual([1.5, 1.5, 4.5, 4.5], [quantized[i] for i in range(4)])
+
+    def test_quantize(self):
+        held_out = list(self.vocabulary.lookup_ids(
+            ["humpty", "dumpty", "sat", "on", "a", "great", "wall"]))
+        report = katz_arrays.quantize(self.flat_model, 4, held_out)
+        self.assertLess(report.nbytes_after, report.nbytes_before)
+        self.assertEqual(report.nbytes_after, self.flat_model.nbytes())
+        self.assertAlmostEqual(
+            self.model.calc_perplexity(held_out), report.perplexity_before)
+        self.assertAlmostEqual(
+            self.flat_model.calc_perplexity(held_out), report.perplexity_after)
+        with tempfile.TemporaryDirectory() as dir_name:
+            fn = os.path.join(dir_name, "katz.model")
+            katzbackoff.save_model(self.flat_model, fn)
+            loaded = katz_arrays.load_model(fn)
+            self.assertEqual(self.flat_model.nbytes(), loaded.nbytes())
+            for n_gram in self._n_grams():
+                self.assertEqual(
+                    self.flat_model.log_p_katz(n_gram), loaded.log_p_katz(n_gram))
+            with self.assertRaises(ValueError):
+                katzbackoff.load_model(fn)
+
+    def test_log_p_katz_batch(self):
+        n_grams = list(self._n_grams())
+        for model in [self.model, self.flat_model]:
+            log_ps = model.log_p_katz_batch(n_grams + n_grams[:10])
+            self.assertEqual(len(n_grams) + 10, len(log_ps))
+            for n_gram, log_p in zip(n_grams + n_grams[:10], log_ps):
+                self.assertAlmostEqual(self.model.log_p_katz(n_gram), log_p)
+            ids = array('Q', (token for n_gram in n_grams if None not in n_gram
+                              for token in n_gram))
+            log_ps = model.log_p_katz_batch(ids, 3)
+            self.assertEqual(len(ids) // 3, len(log_ps))
+            for i, log_p in enumerate(log_ps):
+                self.assertAlmostEqual(
+                    self.model.log_p_katz(tuple(ids[3 * i:3 * i + 3])), log_p)
+
+    def test_parallel_perplexity(self):
+        texts = [TEXT, "Humpty Dumpty stood on a wall.\n" * 5 + TEXT + "\n" + TEXT,
+                 "Humpty\nDumpty\nhad\na\ngreat\nfall\n"]
+        with tempfile.TemporaryDirectory() as dir_name:
+            fn = os.path.join(dir_name, "katz.model")
+            katzbackoff.save_model(self.flat_model, fn)
+            corpus_dir = os.path.join(dir_name, "corpus")
+            os.mkdir(corpus_dir)
+            log_ps = []
+            for i, text in enumerate(texts):
+                with open(os.path.join(corpus_dir, "{}.txt".format(i)), 'w') as f:
+                    f.write(text)
+                log_ps.extend(self.model.score_tokens(self.vocabulary.lookup_ids(
+                    tokenizer.tokenize(io.StringIO(text)))))
+            expected = math.exp(-sum(log_ps) / len(log_ps))
+            for processes, shard_bytes in [(1, 1 << 20), (1, 10), (2, 25), (2, 1)]:
+                self.assertAlmostEqual(
+                    expected,
+                    katz_arrays.parallel_perplexity(
+                        fn, corpus_dir, processes=processes,
+                        shard_bytes=shard_bytes))
+            self.assertAlmostEqual(
+                math.exp(-sum(log_ps[:29]) / 29),
+                katz_arrays.parallel_perplexity(
+                    fn, os.path.join(corpus_dir, "0.txt"), processes=2,
+                    shard_bytes=10))
+            # a string-keyed model gets its vocabulary when saved
+            model = katzbackoff.LanguageModel(katzbackoff.compute_model(
+                katzbackoff.populate_trie_nodes(io.StringIO(
+                    TEXT + " In 1990 the king's men put him back up."), 3), 3), 3)
+            katzbackoff.save_model(model, fn)
+            log_ps = []
+            for text in texts:
+                log_ps.extend(model.score_tokens(
+                    tokenizer.tokenize(io.StringIO(text))))
+            self.assertAlmostEqual(
+                math.exp(-sum(log_ps) / len(log_ps)),
+                katz_arrays.parallel_perplexity(
+                    fn, corpus_dir, processes=2, shard_bytes=25))
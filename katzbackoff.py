@@ -1,42 +1,269 @@
 from ch4 import CircularBuffer, CountFrequency, \
     simple_linear_regression, SimpleGoodTuringCountSmoother
 import math
-from tokenizer import tokenize, detokenize
-import pprint
+from tokenizer import tokenize, detokenize, corpus_files, \
+    parallel_map, parallel_tokenize_files, START, START_ID, Vocabulary
+from array import array
+from collections import OrderedDict
+import model_file
 
 class LanguageModel(object):
-    def __init__(self, trie_node, N):
+    def __init__(self, trie_node, N, vocabulary=None):
+        """
+        If the trie was populated with a vocabulary, pass it here too;
+        n-grams and tokens given to this model are then its integer ids
+        (see Vocabulary.lookup_ids for mapping held-out text).
+        """
         self.trie_node = trie_node
         self.N = N
+        self.vocabulary = vocabulary
+        if vocabulary is not None:
+            self.start = vocabulary.start_id
+        else:
+            self.start = _start_token(trie_node)
 
     def log_p_katz(self, n_gram):
         if n_gram[-1] not in self.trie_node.descendants:
-            return math.log(self.trie_node.beta()) # degenerate case: w_n not in model
-        node = self.trie_node.find_node(n_gram)
+            return self.trie_node.log_beta() # degenerate case: w_n not in model
+        prefix_node = self.trie_node.find_node(n_gram[:-1])
+        node = None
+        if prefix_node is not None:
+            node = prefix_node.descendants.get(n_gram[-1], None)
         if node is not None:
             return node.log_p_star()
         else:
-            prefix = n_gram[:-1]
-            prefix_node = self.trie_node.find_node(prefix)
             suffix = n_gram[1:]
             if prefix_node is None:
                 return self.log_p_katz(suffix)
             else:
                 return prefix_node.log_alpha + self.log_p_katz(suffix)
 
-    def calc_perplexity(self, token_iterator):
-        circ_buff = CircularBuffer(self.N)
+    def log_p_katz_batch(self, n_grams, n=None):
+        """
+        Returns an array of log_p_katz for each of n_grams, a sequence of
+        tuples or, if n is given, a flat sequence of ids (e.g. an array)
+        holding consecutive n-grams. Repeated n-grams are scored once;
+        the rest are resolved one trie level at a time, and those that
+        back off are scored as a batch of their suffixes.
+        """
+        if n is not None:
+            n_grams = [tuple(n_grams[i:i + n]) for i in range(0, len(n_grams), n)]
+        distinct = list(dict.fromkeys(n_grams))
+        log_ps = dict(zip(distinct, self._log_p_katz_distinct(distinct)))
+        return array('d', map(log_ps.__getitem__, n_grams))
+
+    def _log_p_katz_distinct(self, n_grams):
+        root = self._root()
+        child = self._child
+        log_ps = [0.0] * len(n_grams)
+        backoff = []
+        by_length = {}
+        for k, n_gram in enumerate(n_grams):
+            by_length.setdefault(len(n_gram), []).append(k)
+        for n, ks in by_length.items():
+            batch = [n_grams[k] for k in ks]
+            # the nodes of each n-gram's prefix, one level at a time
+            nodes = [root] * len(batch)
+            for level in range(n - 1):
+                nodes = [None if node is None else child(level, node, n_gram[level])
+                         for node, n_gram in zip(nodes, batch)]
+            contexts = nodes
+            nodes = [None if node is None else child(n - 1, node, n_gram[-1])
+                     for node, n_gram in zip(contexts, batch)]
+            for k, n_gram, context, node in zip(ks, batch, contexts, nodes):
+                if node is not None:
+                    log_ps[k] = self._log_p_star(n, node)
+                elif child(0, root, n_gram[-1]) is None:
+                    log_ps[k] = self._unknown_log_p() # degenerate case: w_n not in model
+                else:
+                    if context is not None:
+                        log_ps[k] = self._log_alpha(n - 1, context)
+                    backoff.append(k)
+        if len(backoff) > 0:
+            suffix_log_ps = self.log_p_katz_batch([n_grams[k][1:] for k in backoff])
+            for k, log_p in zip(backoff, suffix_log_ps):
+                log_ps[k] += log_p
+        return log_ps
+
+    # Node access for log_p_katz_batch; n is the node's depth.
+
+    def _root(self):
+        return self.trie_node
+
+    def _child(self, n, node, token):
+        return node.descendants.get(token, None)
+
+    def _log_p_star(self, n, node):
+        return node.log_p_star()
+
+    def _log_alpha(self, n, node):
+        return node.log_alpha
+
+    def _unknown_log_p(self):
+        return self.trie_node.log_beta()
+
+    def num_nodes(self):
+        return sum(len(level)
+                   for level in _trie_levels(self.trie_node, self.N))
+
+    def to_arrays(self):
+        """
+        Returns (metadata, arrays) describing the compiled model level by
+        level: for each order n, the tokens, counts, log_p_stars and
+        log_alphas of the nodes at depth n (grouped by parent, sorted by
+        token id), suffixes_n, the index at depth n-1 of each one's suffix
+        node, and children_{n-1}, the offsets of each depth n-1 node's
+        children. Tokens are vocabulary ids, with the vocabulary stored
+        alongside; a string-keyed model's tokens are given ids before its
+        levels are sorted.
+        """
+        vocabulary = self.vocabulary
+        if vocabulary is None:
+            # every token has a unigram node
+            vocabulary = Vocabulary(sorted(self.trie_node.descendants))
+            token_id = vocabulary.lookup
+        else:
+            token_id = lambda token: token
+        levels = _trie_levels(self.trie_node, self.N, token_id)
+        arrays = {}
+        discount_exponents = []
+        positions = {id(self.trie_node): 0} # node id -> index, level n - 1
+        for n in range(1, self.N + 1):
+            level = levels[n]
+            if len(level) == 0: # e.g. pruned away
+                discount_exponents.append(None)
+            elif level[0].discounter is None:
+                raise ValueError("run compute_model before saving")
+            else:
+                discount_exponents.append(level[0].discounter.b)
+            children = array('Q', [0])
+            for parent in levels[n - 1]:
+                children.append(children[-1] + len(parent.descendants))
+            arrays["children_{}".format(n - 1)] = children
+            arrays["tokens_{}".format(n)] = array(
+                'Q', (token_id(node.n_gram[-1]) for node in level))
+            arrays["counts_{}".format(n)] = array('Q', (node.count for node in level))
+            arrays["log_alphas_{}".format(n)] = array(
+                'd', (math.nan if node.log_alpha is None else node.log_alpha
+                      for node in level))
+            arrays["log_p_stars_{}".format(n)] = array(
+                'd', (node.log_p_star() for node in level))
+            arrays["suffixes_{}".format(n)] = array(
+                'Q', (positions[id(node.suffix_node())] for node in level))
+            positions = {id(node): i for i, node in enumerate(level)}
+        arrays["vocabulary_offsets"], arrays["vocabulary_blob"] = \
+            model_file.vocabulary_arrays(vocabulary)
+        metadata = {
+            "N": self.N,
+            "root_count": self.trie_node.count,
+            # None if SGT left no mass for unseen tokens
+            "root_log_beta": self.trie_node.log_beta()
+                if self.trie_node.beta() > 0 else None,
+            "discount_exponents": discount_exponents,
+            "quantized": False }
+        return metadata, arrays
+
+    def begin_state(self):
+        """
+        Returns the scoring state for the start of a sequence, i.e. after
+        N - 1 start tokens. A state is the trie node for the longest
+        suffix of the last N - 1 tokens that is in the trie; since every
+        suffix of an n-gram in the trie is in the trie too, that node
+        determines log_p_katz for whatever token comes next.
+        """
+        node = self.trie_node
         for i in range(self.N - 1):
-            circ_buff.add("<s>")
+            child = node.descendants.get(self.start, None)
+            if child is None:
+                break
+            node = child
+        return node
+
+    def score(self, state, token):
+        """
+        Returns (log_p, next_state): log_p_katz of token following the
+        history state stands for, and the state for that history
+        extended by token. Only backs off along suffix links from state,
+        so scoring a sequence takes amortized O(1) trie steps per token.
+        """
+        root = self.trie_node
+        if token not in root.descendants:
+            return root.log_beta(), root # degenerate case: token not in model
+        log_alpha = 0.0
+        node = state
+        child = node.descendants.get(token, None)
+        while child is None:
+            log_alpha += node.log_alpha
+            node = node.suffix_node()
+            child = node.descendants.get(token, None)
+        log_p = log_alpha + child.log_p_star()
+        if len(child.n_gram) == self.N:
+            child = child.suffix_node()
+        return log_p, child
+
+    def score_tokens(self, token_iterator):
+        """
+        Yields log_p_katz for each token given its predecessors, padded
+        with start tokens as in calc_perplexity.
+        """
+        state = self.begin_state()
+        for token in token_iterator:
+            log_p, state = self.score(state, token)
+            yield log_p
+
+    def calc_perplexity(self, token_iterator):
         sum_log_p = 0.0
         token_count = 0
-        for token in token_iterator:
+        for log_p in self.score_tokens(token_iterator):
             token_count += 1
-            circ_buff.add(token)
-            n_gram = circ_buff.make_snapshot_tuple()
-            sum_log_p += self.log_p_katz(n_gram)
+            sum_log_p += log_p
         return math.exp(-(1/token_count) * sum_log_p)
 
+class LogProbCache(object):
+    """
+    A bounded least-recently-used cache in front of a log probability
+    function such as LanguageModel.log_p_katz. Calling it with an n-gram
+    returns log_p(n_gram), so it can stand in for log_p wherever one is
+    expected, e.g. as the model for bag_generation.most_likely_sequence.
+    hits and misses count lookups since creation or the last clear.
+    """
+    def __init__(self, log_p, max_size=1 << 16):
+        self.log_p = log_p
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, n_gram):
+        entries = self.entries
+        log_p = entries.get(n_gram, None)
+        if log_p is not None:
+            self.hits += 1
+            entries.move_to_end(n_gram)
+            return log_p
+        self.misses += 1
+        log_p = entries[n_gram] = self.log_p(n_gram)
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+        return log_p
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "entries: {}/{}, hits: {}, misses: {}, hit rate: {:.2%}".format(
+            len(self.entries), self.max_size, self.hits, self.misses,
+            self.hit_rate())
+
+    def __repr__(self):
+        return str(self)
+
 class KatzTrieNode(object):
     def __init__(self, n_gram=None, parent=None):
         if n_gram is None:
@@ -48,6 +275,17 @@ class KatzTrieNode(object):
         self.log_alpha = None
         self.discounter = None
         self.descendants = {}
+        self._suffix_node = None
+        self._extensions = None # nodes whose suffix node this is
+        # filled in by compute_model, see _add_probabilities
+        self._p_star = None
+        self._log_p_star = None
+        self._beta = None
+        self._log_beta = None
+        self._backoff_c_star = None # see _add_alphas
+        # root only, per order: see compute_model
+        self._count_frequencies = None
+        self._discounters = None
 
     def populate(self, N_gram):
         self.count += 1
@@ -59,35 +297,82 @@ class KatzTrieNode(object):
                     suffix[0], KatzTrieNode(N_gram[:len(self.n_gram) + 1], self))
             descendant.populate(N_gram)
 
-    def _is_start_prefix(self):
-        return next((t for t in self.n_gram if t != '<s>'), None) is None
+    def merge(self, other, token_map=None):
+        """
+        Adds the counts of trie other into this one; both should be
+        merged before compute_model. token_map, if given, maps other's
+        tokens to this trie's, e.g. Vocabulary.add to merge a string-keyed
+        trie into one keyed by vocabulary ids.
+        """
+        self.count += other.count
+        for token, other_descendant in other.descendants.items():
+            if token_map is not None:
+                token = token_map(token)
+            descendant = self.descendants.get(token, None)
+            if descendant is None:
+                descendant = self.descendants[token] = KatzTrieNode(
+                    self.n_gram + (token,), self)
+            descendant.merge(other_descendant, token_map)
 
-    def populate_count_frequencies(self, gt_counts, n):
-        if n == len(self.n_gram) and not self._is_start_prefix():
-            gt_counts[self.count] = gt_counts.get(self.count, 0) + 1
-        else:
-            for descendant in self.descendants.values():
-                descendant.populate_count_frequencies(gt_counts, n)
+    def _is_start_prefix(self, start=START):
+        return next((t for t in self.n_gram if t != start), None) is None
+
+    def _level(self, n):
+        """
+        Returns this node's descendants of order n (as _trie_levels).
+        """
+        depth = len(self.n_gram)
+        if n < depth:
+            return []
+        return _trie_levels(self, n - depth)[n - depth]
+
+    def populate_count_frequencies(self, gt_counts, n, start=START):
+        for node in self._level(n):
+            if not node._is_start_prefix(start):
+                gt_counts[node.count] = gt_counts.get(node.count, 0) + 1
 
     def set_discounter(self, discounter, n):
-        if n == len(self.n_gram):
-            self.discounter = discounter
-        else:
-            for descendant in self.descendants.values():
-                descendant.set_discounter(discounter, n)
+        for node in self._level(n):
+            node.discounter = discounter
+        if self._discounters is not None: # the root of a compiled trie
+            self._discounters[n] = discounter
 
     def c_star(self):
         return self.discounter(self.count)
 
     def p_star(self):
+        if self._p_star is not None:
+            return self._p_star
         return self.c_star() / self.parent.count
 
     def log_p_star(self):
+        if self._log_p_star is not None:
+            return self._log_p_star
         return math.log(self.c_star()) - math.log(self.parent.count)
 
     def beta(self):
+        if self._beta is not None:
+            return self._beta
         return 1 - sum(d.p_star() for d in self.descendants.values())
 
+    def log_beta(self):
+        if self._log_beta is None:
+            self._log_beta = math.log(self.beta())
+        return self._log_beta
+
+    def suffix_node(self):
+        """
+        Returns the node for n_gram[1:] (the backoff node). compute_model
+        links every node; otherwise it's looked up from the root once and
+        then remembered.
+        """
+        if self._suffix_node is None:
+            root = self
+            while root.parent is not None:
+                root = root.parent
+            self._suffix_node = root.find_node(self.n_gram[1:])
+        return self._suffix_node
+
     def find_node(self, n_gram):
         if len(n_gram) == 0:
             return self
@@ -98,59 +383,454 @@ class KatzTrieNode(object):
             else:
                 return None
 
-def _add_discounts(trie_node, N):
-    for n in range(1, N + 1):
-        gt_counts = {} # map of c to N_c
-        trie_node.populate_count_frequencies(gt_counts, n)
-        count_frequencies = [CountFrequency(r, N_r) for r, N_r in gt_counts.items()]
-        a, b = simple_linear_regression(count_frequencies)
-        trie_node.set_discounter(SimpleGoodTuringCountSmoother(b), n)
-
-def _add_alphas(trie_node, N):
-    stack = [trie_node]
-    num_tokens = sum(tn.count for tn in stack)
-    while len(stack) > 0:
-        node = stack.pop()
-        if len(node.n_gram) > 0:
-            beta_n_1 = node.beta()
-            suffix_node = trie_node.find_node(node.n_gram[1:])
-            denominator = 1 - sum(d.p_star() for token, d
-                                  in suffix_node.descendants.items()
-                                  if token in node.descendants)
-            node.log_alpha = math.log(beta_n_1) - math.log(denominator)
+def _add_count_frequencies(trie_node, levels, start=START):
+    """
+    Stores on trie_node, for each order, the map of c to N_c over the
+    nodes of levels (as returned by _trie_levels) seen c times. The
+    node of each order made only of start tokens is left out.
+    """
+    trie_node._count_frequencies = [None]
+    start_node = trie_node
+    for level in levels[1:]:
+        if start_node is not None:
+            start_node = start_node.descendants.get(start, None)
+        gt_counts = {}
+        for node in level:
+            if node is not start_node:
+                gt_counts[node.count] = gt_counts.get(node.count, 0) + 1
+        trie_node._count_frequencies.append(gt_counts)
+
+def _move_count_frequency(gt_counts, old_count, count):
+    if old_count > 0:
+        gt_counts[old_count] -= 1
+        if gt_counts[old_count] == 0:
+            del gt_counts[old_count]
+    gt_counts[count] = gt_counts.get(count, 0) + 1
+
+def _fit_discounter(gt_counts):
+    """
+    Fits a Simple Good-Turing discounter to gt_counts, a map of c to N_c.
+    """
+    count_frequencies = [CountFrequency(r, N_r) for r, N_r in gt_counts.items()]
+    a, b = simple_linear_regression(count_frequencies)
+    return SimpleGoodTuringCountSmoother(b)
+
+def _add_suffix_links(level):
+    """
+    Links each node of level to the node for its n_gram[1:], given the
+    links of the level above: the suffix of parent + (token,) is
+    parent's suffix + (token,). Each node is also added to its suffix's
+    _extensions, and its own are cleared for the level below to fill.
+    """
+    for node in level:
+        node._extensions = None
+        parent = node.parent
+        if parent.parent is None:
+            suffix = parent
+        else:
+            suffix = parent._suffix_node.descendants[node.n_gram[-1]]
+        node._suffix_node = suffix
+        if suffix._extensions is None:
+            suffix._extensions = []
+        suffix._extensions.append(node)
+
+def _add_probabilities(nodes):
+    """
+    Stores p_star and log_p_star on the children of each of nodes and
+    beta on each of nodes, so queries don't recompute discounts or sum
+    over children. Counts must not change afterwards without rerunning
+    compute_model.
+    """
+    for node in nodes:
+        node._log_beta = None
+        p_star_sum = 0.0
         for descendant in node.descendants.values():
-            stack.append(descendant)
+            c_star = descendant.c_star()
+            descendant._p_star = c_star / node.count
+            descendant._log_p_star = math.log(c_star) - math.log(node.count)
+            p_star_sum += descendant._p_star
+        node._beta = 1 - p_star_sum
+
+def _add_alphas(level):
+    """
+    Needs the suffix links and probabilities of level and the level
+    below. The child of node's suffix for token is the suffix of node's
+    child for token, so the backoff denominator sums over node's own
+    children. The sum is kept unnormalized, as discounted counts, so
+    update_model can renormalize it when only the suffix's count changes
+    and adjust it when one of the summed counts does.
+    """
+    for node in level:
+        suffix_count = node._suffix_node.count
+        node._backoff_c_star = suffix_count * sum(
+            d._suffix_node.p_star() for d in node.descendants.values())
+        _set_log_alpha(node)
 
-def populate_trie_nodes(f, N, include_punctuation=False, trie_node=None):
+def _set_log_alpha(node):
+    denominator = 1 - node._backoff_c_star / node._suffix_node.count
+    node.log_alpha = math.log(node.beta()) - math.log(denominator)
+
+def populate_trie_nodes(f, N, include_punctuation=False, trie_node=None,
+                        vocabulary=None):
+    """
+    If vocabulary is given, the trie is keyed by its integer ids.
+    """
+    tokens = tokenize(f, include_punctuation=include_punctuation)
+    if vocabulary is not None:
+        return populate_trie_nodes_from_tokens(
+            vocabulary.to_ids(tokens), N, trie_node, vocabulary.start_id)
+    return populate_trie_nodes_from_tokens(tokens, N, trie_node)
+
+def populate_trie_nodes_from_tokens(tokens, N, trie_node=None, start=START):
     if trie_node is None:
         trie_node = KatzTrieNode()
     circ_buff = CircularBuffer(N)
     for i in range(N - 1):
-        circ_buff.add("<s>")
+        circ_buff.add(start)
     n_gram = None
-    for token in tokenize(f, include_punctuation=include_punctuation):
+    for token in tokens:
         circ_buff.add(token)
         n_gram = circ_buff.make_snapshot_tuple()
         trie_node.populate(n_gram)
-    for i in range(1, len(n_gram)):
-        trie_node.populate(n_gram[i:])
+    if n_gram is not None:
+        for i in range(1, len(n_gram)):
+            trie_node.populate(n_gram[i:])
     return trie_node
 
-def compute_trie_nodes_for_dir(dir_name, N, include_punctuation=False):
+def _populate_file_trie_nodes(args):
+    fn, N, include_punctuation = args
+    with open(fn, 'r') as f:
+        return populate_trie_nodes(f, N, include_punctuation)
+
+def compute_trie_nodes_for_dir(dir_name, N, include_punctuation=False,
+                               processes=1, vocabulary=None,
+                               count_in_workers=False):
+    """
+    processes is the number of worker processes; None uses every core.
+    By default workers only tokenize (splitting large files into shards);
+    with count_in_workers each file's trie is built in its own worker (or
+    in turn here, if processes is 1) and the tries are merged here.
+    Either way, run compute_model once on the result.
+    """
     trie_node = KatzTrieNode()
-    for fn in os.listdir(dir_name):
-        if fn == '.DS_Store':
-            continue
-        full_fn = os.path.join(dir_name, fn)
-        with open(full_fn, 'r') as f:
-            populate_trie_nodes(f, N, include_punctuation, trie_node)
+    if count_in_workers:
+        token_map = vocabulary.add if vocabulary is not None else None
+        for file_trie_node in parallel_map(
+                _populate_file_trie_nodes,
+                [(fn, N, include_punctuation) for fn in corpus_files(dir_name)],
+                processes):
+            trie_node.merge(file_trie_node, token_map)
+    elif processes == 1:
+        for full_fn in corpus_files(dir_name):
+            with open(full_fn, 'r') as f:
+                populate_trie_nodes(
+                    f, N, include_punctuation, trie_node, vocabulary)
+    else:
+        for fn, tokens in parallel_tokenize_files(
+                corpus_files(dir_name), include_punctuation, processes):
+            if vocabulary is not None:
+                populate_trie_nodes_from_tokens(
+                    vocabulary.to_ids(tokens), N, trie_node,
+                    vocabulary.start_id)
+            else:
+                populate_trie_nodes_from_tokens(tokens, N, trie_node)
     return trie_node
 
-def compute_trie_nodes_for_file(fn, N, include_punctuation=False):
+def compute_trie_nodes_for_file(fn, N, include_punctuation=False,
+                                vocabulary=None):
     with open(fn, 'r') as f:
-        return populate_trie_nodes(f, N, include_punctuation)
+        return populate_trie_nodes(
+            f, N, include_punctuation, vocabulary=vocabulary)
+
+def _start_token(trie_node):
+    """
+    Returns the sentence-start padding token of trie_node's n-grams:
+    START_ID if they're vocabulary ids, else START.
+    """
+    token = next(iter(trie_node.descendants), None)
+    return START_ID if isinstance(token, int) else START
 
-def compute_model(trie_node, N):
-    _add_discounts(trie_node, N)
-    _add_alphas(trie_node, N)
+def compute_model(trie_node, N, start=None):
+    """
+    start is the sentence-start padding token; by default it's told
+    from the trie's keys (see _start_token).
+
+    Works one trie level at a time, touching each node a constant number
+    of times per pass. The count frequencies and discounter of each
+    order are kept on trie_node for update_model.
+    """
+    if start is None:
+        start = _start_token(trie_node)
+    levels = _trie_levels(trie_node, N)
+    _add_count_frequencies(trie_node, levels, start)
+    trie_node._discounters = [None]
+    trie_node._extensions = None
+    for n in range(1, N + 1):
+        discounter = _fit_discounter(trie_node._count_frequencies[n])
+        trie_node._discounters.append(discounter)
+        for node in levels[n]:
+            node.discounter = discounter
+        _add_suffix_links(levels[n])
+    for level in levels:
+        _add_probabilities(level)
+    for level in levels[1:]:
+        _add_alphas(level)
     return trie_node
+
+def update_model(model, tokens, discount_tolerance=0.01):
+    """
+    Adds the n-grams of tokens (counted as populate_trie_nodes_from_tokens
+    would) to compiled LanguageModel model, in place, without rerunning
+    compute_model. The work is proportional to the nodes whose counts
+    change, the nodes that back off to them (found through their
+    _extensions) and the unigrams, whose probabilities all depend on the
+    total count.
+
+    Each order's discounter is refit from count frequencies kept up to
+    date as counts change, but only replaced if its exponent moved by
+    more than discount_tolerance; then every node of that order is
+    rediscounted, which takes a pass over the trie. So with a tolerance
+    above 0, the model drifts slightly from what compute_model would
+    build from the same counts; 0 reproduces compute_model (at the cost
+    of the pass on most updates).
+    """
+    N = model.N
+    root = model.trie_node
+    delta = populate_trie_nodes_from_tokens(tokens, N, start=model.start)
+    if delta.count == 0:
+        return model
+    if root._count_frequencies is None: # e.g. after load_model or prune
+        _add_count_frequencies(root, _trie_levels(root, N), model.start)
+    changed = [[] for n in range(N + 1)] # (node, old count) by order
+    new_nodes = set() # ids
+    pairs = [(root, delta)]
+    while len(pairs) > 0:
+        node, delta_node = pairs.pop()
+        changed[len(node.n_gram)].append((node, node.count))
+        node.count += delta_node.count
+        for token, delta_child in delta_node.descendants.items():
+            child = node.descendants.get(token, None)
+            if child is None:
+                child = node.descendants[token] = KatzTrieNode(
+                    node.n_gram + (token,), node)
+                new_nodes.add(id(child))
+            pairs.append((child, delta_child))
+    for n in range(1, N + 1):
+        _add_suffix_links([node for node, old_count in changed[n]
+                           if id(node) in new_nodes])
+    levels = None # only built if an order is rediscounted
+    contexts = {id(root): root} # nodes whose children's probabilities changed
+    backoff_changed = {} # nodes whose backoff sums are recomputed in full
+    log_alphas = {} # nodes whose alphas are renormalized
+    for unigram in root.descendants.values():
+        log_alphas[id(unigram)] = unigram # the root's count changed
+    start_node = root
+    for n in range(1, N + 1):
+        if start_node is not None:
+            start_node = start_node.descendants.get(model.start, None)
+        gt_counts = root._count_frequencies[n]
+        for node, old_count in changed[n]:
+            if node is not start_node:
+                _move_count_frequency(gt_counts, old_count, node.count)
+        discounter = _fit_discounter(gt_counts)
+        old_discounter = root._discounters[n]
+        rediscount = (old_discounter is None
+                      or abs(discounter.b - old_discounter.b) > discount_tolerance)
+        if rediscount:
+            root._discounters[n] = discounter
+            if levels is None:
+                levels = _trie_levels(root, N)
+            for node in levels[n]:
+                node.discounter = discounter
+            contexts.update((id(node), node) for node in levels[n - 1])
+            # their children back off to rediscounted nodes
+            backoff_changed.update((id(node), node) for node in levels[n])
+        for node, old_count in changed[n]:
+            contexts[id(node)] = node
+            if id(node) in new_nodes:
+                node.discounter = root._discounters[n]
+            if node._extensions is None:
+                continue
+            # node's count changed, and so did its c_star, which the
+            # backoff sum of every extension's parent includes
+            c_star = node.c_star()
+            old_c_star = old_discounter(old_count) if old_count > 0 else 0.0
+            for extension in node._extensions:
+                log_alphas[id(extension)] = extension
+                parent = extension.parent
+                if rediscount or id(parent) in backoff_changed:
+                    continue
+                if parent._backoff_c_star is None: # e.g. after load_model
+                    backoff_changed[id(parent)] = parent
+                elif id(extension) in new_nodes:
+                    parent._backoff_c_star += c_star
+                    log_alphas[id(parent)] = parent
+                else:
+                    parent._backoff_c_star += c_star - old_c_star
+                    log_alphas[id(parent)] = parent
+    _add_probabilities(contexts.values())
+    _add_alphas(backoff_changed.values())
+    log_alphas.update(contexts)
+    for node in log_alphas.values():
+        if node is root or id(node) in backoff_changed:
+            continue
+        if node._backoff_c_star is None:
+            _add_alphas((node,))
+        else:
+            _set_log_alpha(node)
+    return model
+
+class PruneReport(object):
+    def __init__(self, num_nodes_before, num_nodes_after,
+                 perplexity_before=None, perplexity_after=None):
+        self.num_nodes_before = num_nodes_before
+        self.num_nodes_after = num_nodes_after
+        self.perplexity_before = perplexity_before
+        self.perplexity_after = perplexity_after
+
+    def __str__(self):
+        s = "nodes: {} -> {}".format(self.num_nodes_before, self.num_nodes_after)
+        if self.perplexity_before is not None:
+            s += ", perplexity: {:.4f} -> {:.4f} ({:+.4%})".format(
+                self.perplexity_before, self.perplexity_after,
+                self.perplexity_after / self.perplexity_before - 1)
+        return s
+
+    def __repr__(self):
+        return str(self)
+
+def _pruning_entropy(node, root_count):
+    """
+    Returns the relative entropy between the model with and without
+    node's n-gram, weighting its history by relative frequency (Stolcke,
+    "Entropy-based Pruning of Backoff Language Models", 1998). Without
+    the n-gram, its probability mass moves into its history's beta, and
+    the history's alpha is renormalized.
+    """
+    history = node.parent
+    p = node.p_star()
+    p_backoff = node._suffix_node.p_star()
+    beta = history.beta()
+    log_alpha = history.log_alpha
+    denominator = beta / math.exp(log_alpha)
+    log_alpha_pruned = math.log(beta + p) - math.log(denominator + p_backoff)
+    return -(history.count / root_count) * (
+        p * (math.log(p_backoff) + log_alpha_pruned - math.log(p))
+        + beta * (log_alpha_pruned - log_alpha))
+
+def prune(model, threshold=None, min_count=None, tokens=None):
+    """
+    Removes n-grams of order 2 and up from the compiled model in place:
+    those whose removal changes the model's relative entropy by less
+    than threshold (see _pruning_entropy), and those seen fewer than
+    min_count times. An n-gram is only removed if it is not the history
+    or the backoff suffix of one that's kept, so the trie stays
+    suffix-closed. Alphas and betas of the affected histories are
+    recomputed; discounts are not refit.
+
+    Returns a PruneReport; if tokens (a sequence, scored twice) is
+    given, it includes the model's perplexity on them before and after.
+    """
+    report = PruneReport(model.num_nodes(), None)
+    if tokens is not None:
+        report.perplexity_before = model.calc_perplexity(tokens)
+    root = model.trie_node
+    levels = _trie_levels(root, model.N)
+    suffixes = set() # ids of the nodes kept nodes of the order above back off to
+    for n in range(model.N, 1, -1):
+        pruned = set()
+        histories = {}
+        for node in levels[n]:
+            if (len(node.descendants) == 0 and id(node) not in suffixes
+                    and ((min_count is not None and node.count < min_count)
+                         or (threshold is not None and
+                             _pruning_entropy(node, root.count) < threshold))):
+                pruned.add(id(node))
+                histories[id(node.parent)] = node.parent
+        pruned_suffixes = {}
+        for node in levels[n]:
+            if id(node) in pruned:
+                del node.parent.descendants[node.n_gram[-1]]
+                pruned_suffixes[id(node._suffix_node)] = node._suffix_node
+        for suffix in pruned_suffixes.values():
+            suffix._extensions = [extension for extension in suffix._extensions
+                                  if id(extension) not in pruned]
+        _add_probabilities(histories.values())
+        _add_alphas(histories.values())
+        suffixes = set(id(node._suffix_node) for node in levels[n]
+                       if id(node) not in pruned)
+    root._count_frequencies = None # recounted by update_model if needed
+    report.num_nodes_after = model.num_nodes()
+    if tokens is not None:
+        report.perplexity_after = model.calc_perplexity(tokens)
+    return report
+
+def _trie_levels(trie_node, N, token_key=None):
+    """
+    Returns a list of the nodes at each depth 0..N of the trie, each
+    level grouped by parent (in the parent level's order) and, if
+    token_key is given, sorted by token_key(token) within a parent.
+    """
+    levels = [[trie_node]]
+    for n in range(1, N + 1):
+        level = []
+        for parent in levels[-1]:
+            if token_key is not None:
+                level.extend(parent.descendants[token] for token in
+                             sorted(parent.descendants, key=token_key))
+            else:
+                level.extend(parent.descendants.values())
+        levels.append(level)
+    return levels
+
+def save_model(model, fn):
+    """
+    Writes LanguageModel model, whose trie has been through
+    compute_model, to fn as a model file. The model load_model returns is
+    keyed by vocabulary ids even if this one is keyed by strings.
+    """
+    metadata, arrays = model.to_arrays()
+    model_file.write(fn, "katz", metadata, arrays)
+
+def load_model(fn):
+    """
+    Reads a model written by save_model, rebuilding its trie from the
+    mapped arrays without retraining. Quantized models (see
+    katz_arrays.quantize) can only be loaded with katz_arrays.load_model.
+    """
+    metadata, arrays = model_file.read(fn, "katz")
+    if metadata.get("quantized", False):
+        raise ValueError(
+            "{} holds a quantized model; load it with katz_arrays.load_model".format(fn))
+    N = metadata["N"]
+    trie_node = KatzTrieNode()
+    trie_node.count = metadata["root_count"]
+    trie_node._discounters = [None]
+    level = [trie_node]
+    nodes = [trie_node]
+    for n in range(1, N + 1):
+        discount_exponent = metadata["discount_exponents"][n - 1]
+        discounter = None # no nodes of this order to discount
+        if discount_exponent is not None:
+            discounter = SimpleGoodTuringCountSmoother(discount_exponent)
+        trie_node._discounters.append(discounter)
+        children = arrays["children_{}".format(n - 1)]
+        tokens = arrays["tokens_{}".format(n)]
+        counts = arrays["counts_{}".format(n)]
+        log_alphas = arrays["log_alphas_{}".format(n)]
+        next_level = []
+        for i, parent in enumerate(level):
+            for j in range(children[i], children[i + 1]):
+                node = KatzTrieNode(parent.n_gram + (tokens[j],), parent)
+                node.count = counts[j]
+                node.log_alpha = None if math.isnan(log_alphas[j]) else log_alphas[j]
+                node.discounter = discounter
+                parent.descendants[tokens[j]] = node
+                next_level.append(node)
+        _add_suffix_links(next_level)
+        nodes.extend(next_level)
+        level = next_level
+    _add_probabilities(nodes)
+    vocabulary = model_file.read_vocabulary(
+        arrays["vocabulary_offsets"], arrays["vocabulary_blob"])
+    return LanguageModel(trie_node, N, vocabulary)
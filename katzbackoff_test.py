@@ -1,6 +1,6 @@
-import ch4, katzbackoff
+import bag_generation, ch4, katzbackoff, tokenizer
 import unittest
-import io, math
+import io, math, os, tempfile
 
 class LanguageModelTests(unittest.TestCase):
     def test_trie_nodes(self):
@@ -156,3 +156,297 @@ class LanguageModelTests(unittest.TestCase):
         model = katzbackoff.LanguageModel(trie_node, 3)
         p_katz = math.exp(model.log_p_katz(("fat", "cat", "stood")))
         self.assertAlmostEqual(trie_node.beta(), p_katz, 6)
+
+    def test_vocabulary_ids(self):
+        text = ("Humpty Dumpty sat on a wall, "
+                "Humpty Dumpty had a great fall; "
+                "All the king's horses and all the king's men "
+                "Couldn't put Dumpty together again.")
+        model = katzbackoff.LanguageModel(katzbackoff.compute_model(
+            katzbackoff.populate_trie_nodes(io.StringIO(text), 3), 3), 3)
+        vocabulary = tokenizer.Vocabulary()
+        trie_node = katzbackoff.populate_trie_nodes(
+            io.StringIO(text), 3, vocabulary=vocabulary)
+        id_model = katzbackoff.LanguageModel(
+            katzbackoff.compute_model(trie_node, 3, vocabulary.start_id),
+            3, vocabulary)
+        held_out = ["humpty", "dumpty", "stood", "on", "a", "wall"]
+        self.assertAlmostEqual(
+            model.calc_perplexity(iter(held_out)),
+            id_model.calc_perplexity(vocabulary.lookup_ids(held_out)))
+        # the start id is the default for a trie keyed by ids
+        default_start_model = katzbackoff.LanguageModel(
+            katzbackoff.compute_model(katzbackoff.populate_trie_nodes(
+                io.StringIO(text), 3, vocabulary=vocabulary), 3), 3)
+        self.assertEqual(vocabulary.start_id, default_start_model.start)
+        self.assertAlmostEqual(
+            model.calc_perplexity(iter(held_out)),
+            default_start_model.calc_perplexity(vocabulary.lookup_ids(held_out)))
+
+    def _all_counts(self, trie_node):
+        counts = {}
+        stack = [trie_node]
+        while len(stack) > 0:
+            node = stack.pop()
+            counts[node.n_gram] = node.count
+            stack.extend(node.descendants.values())
+        return counts
+
+    def test_merge(self):
+        texts = ["Humpty Dumpty sat on a wall, Humpty Dumpty had a great fall;",
+                 "All the king's horses and all the king's men "
+                 "Couldn't put Humpty together again."]
+        trie_node = katzbackoff.KatzTrieNode()
+        for text in texts:
+            katzbackoff.populate_trie_nodes(io.StringIO(text), 3, trie_node=trie_node)
+        merged = katzbackoff.populate_trie_nodes(io.StringIO(texts[0]), 3)
+        merged.merge(katzbackoff.populate_trie_nodes(io.StringIO(texts[1]), 3))
+        self.assertEqual(self._all_counts(trie_node), self._all_counts(merged))
+        self.assertIs(merged, merged.find_node(('humpty', 'together')).parent.parent)
+
+    def test_trie_nodes_for_dir_in_workers(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            for i, text in enumerate([
+                    "Humpty Dumpty sat on a wall,\nHumpty Dumpty had a great fall;\n",
+                    "All the king's horses and all the king's men\n"
+                    "Couldn't put Humpty together again.\n"]):
+                with open(os.path.join(dir_name, "{}.txt".format(i)), 'w') as f:
+                    f.write(text)
+            trie_node = katzbackoff.compute_trie_nodes_for_dir(dir_name, 3)
+            vocabulary = tokenizer.Vocabulary()
+            merged = katzbackoff.compute_trie_nodes_for_dir(
+                dir_name, 3, processes=2, vocabulary=vocabulary,
+                count_in_workers=True)
+            self.assertEqual(
+                self._all_counts(trie_node),
+                { tuple(vocabulary.to_tokens(k)): v
+                  for k, v in self._all_counts(merged).items() })
+            in_process = katzbackoff.compute_trie_nodes_for_dir(
+                dir_name, 3, count_in_workers=True)
+            self.assertEqual(
+                self._all_counts(trie_node), self._all_counts(in_process))
+
+    def test_save_load(self):
+        f = io.StringIO(
+            "Humpty Dumpty sat on a wall, "
+            "Humpty Dumpty had a great fall; "
+            "All the king's horses and all the king's men "
+            "Couldn't put Dumpty together again.")
+        trie_node = katzbackoff.compute_model(katzbackoff.populate_trie_nodes(f, 3), 3)
+        model = katzbackoff.LanguageModel(trie_node, 3)
+        with tempfile.TemporaryDirectory() as dir_name:
+            fn = os.path.join(dir_name, "katz.model")
+            katzbackoff.save_model(model, fn)
+            loaded = katzbackoff.load_model(fn)
+            vocabulary = loaded.vocabulary
+            for n_gram in [("humpty", "dumpty", "together"), ("couch", "cat", "sat"),
+                           ("humpty", "dumpty", "stood"), ("all", "the", "king")]:
+                self.assertAlmostEqual(
+                    model.log_p_katz(n_gram),
+                    loaded.log_p_katz(tuple(vocabulary.lookup_ids(n_gram))))
+            self.assertEqual(
+                self._all_counts(trie_node),
+                { tuple(vocabulary.to_tokens(k)): v
+                  for k, v in self._all_counts(loaded.trie_node).items() })
+
+    def test_precomputed_probabilities(self):
+        f = io.StringIO(
+            "Humpty Dumpty sat on a wall, "
+            "Humpty Dumpty had a great fall; "
+            "All the king's horses and all the king's men "
+            "Couldn't put Dumpty together again.")
+        trie_node = katzbackoff.compute_model(katzbackoff.populate_trie_nodes(f, 3), 3)
+        for n_gram, node in self._n_gram_nodes(trie_node, 2).items():
+            self.assertEqual(node.c_star() / node.parent.count, node._p_star)
+            self.assertEqual(
+                math.log(node.c_star()) - math.log(node.parent.count),
+                node._log_p_star)
+            self.assertEqual(
+                1 - sum(d.c_star() / node.count for d in node.descendants.values()),
+                node._beta)
+        self.assertAlmostEqual(math.log(trie_node.beta()), trie_node.log_beta())
+
+    def test_suffix_links(self):
+        f = io.StringIO(
+            "Humpty Dumpty sat on a wall, "
+            "Humpty Dumpty had a great fall; "
+            "All the king's horses and all the king's men "
+            "Couldn't put Dumpty together again.")
+        trie_node = katzbackoff.compute_model(katzbackoff.populate_trie_nodes(f, 3), 3)
+        for n in range(1, 4):
+            for n_gram, node in self._n_gram_nodes(trie_node, n).items():
+                self.assertIs(trie_node.find_node(n_gram[1:]), node._suffix_node)
+
+    def _pruning_model(self):
+        f = io.StringIO(
+            "Humpty Dumpty sat on a wall, "
+            "Humpty Dumpty had a great fall; "
+            "All the king's horses and all the king's men "
+            "Couldn't put Dumpty together again.")
+        return katzbackoff.LanguageModel(
+            katzbackoff.compute_model(katzbackoff.populate_trie_nodes(f, 3), 3), 3)
+
+    def _assert_pruned_trie_consistent(self, trie_node):
+        num_extensions = 0
+        for n in range(1, 4):
+            for n_gram, node in self._n_gram_nodes(trie_node, n).items():
+                self.assertIs(trie_node.find_node(n_gram[1:]), node._suffix_node)
+                self.assertIn(node, node._suffix_node._extensions)
+                num_extensions += len(node._extensions or ())
+                denominator = 1 - sum(trie_node.find_node(d.n_gram[1:]).p_star()
+                                      for d in node.descendants.values())
+                self.assertAlmostEqual(
+                    math.log(node.beta()) - math.log(denominator), node.log_alpha)
+        num_extensions += len(trie_node._extensions)
+        self.assertEqual(
+            sum(len(self._n_gram_nodes(trie_node, n)) for n in range(1, 4)),
+            num_extensions)
+
+    def test_prune_min_count(self):
+        model = self._pruning_model()
+        num_unigrams = len(model.trie_node.descendants)
+        tokens = list(tokenizer.tokenize(io.StringIO("Humpty Dumpty sat on the wall")))
+        report = katzbackoff.prune(model, min_count=2, tokens=tokens)
+        self.assertLess(report.num_nodes_after, report.num_nodes_before)
+        self.assertEqual(report.num_nodes_after, model.num_nodes())
+        self.assertEqual(report.perplexity_after, model.calc_perplexity(tokens))
+        trie_node = model.trie_node
+        self.assertIsNone(trie_node.find_node(('sat', 'on')))
+        self.assertIsNotNone(trie_node.find_node(('humpty', 'dumpty')))
+        self.assertIsNone(trie_node.find_node(('humpty', 'dumpty', 'sat')))
+        self.assertEqual(num_unigrams, len(trie_node.descendants))
+        self._assert_pruned_trie_consistent(trie_node)
+
+    def test_prune_threshold(self):
+        model = self._pruning_model()
+        report = katzbackoff.prune(model, threshold=0.0)
+        self.assertEqual(report.num_nodes_before, report.num_nodes_after)
+        report = katzbackoff.prune(model, threshold=1.0)
+        # only unigrams and what they need are left
+        self.assertEqual(1 + len(model.trie_node.descendants), report.num_nodes_after)
+        self._assert_pruned_trie_consistent(model.trie_node)
+
+    def test_save_load_pruned(self):
+        model = self._pruning_model()
+        katzbackoff.prune(model, threshold=1.0)
+        n_grams = [('humpty', 'dumpty', 'sat'), ('<s>', '<s>', 'humpty'),
+                   ('a', 'great', 'wall'), ('the', "king", "'s")]
+        with tempfile.TemporaryDirectory() as dir_name:
+            fn = os.path.join(dir_name, "katz.model")
+            katzbackoff.save_model(model, fn)
+            loaded = katzbackoff.load_model(fn)
+            self.assertEqual(model.num_nodes(), loaded.num_nodes())
+            for n_gram in n_grams:
+                self.assertAlmostEqual(
+                    model.log_p_katz(n_gram),
+                    loaded.log_p_katz(tuple(loaded.vocabulary.lookup_ids(n_gram))))
+
+    def test_log_prob_cache(self):
+        model = self._pruning_model()
+        cache = katzbackoff.LogProbCache(model.log_p_katz, max_size=2)
+        n_grams = [('humpty', 'dumpty', 'sat'), ('a', 'great', 'wall'),
+                   ('humpty', 'dumpty', 'sat'), ('sat', 'on', 'a'),
+                   ('a', 'great', 'wall')]
+        for n_gram in n_grams:
+            self.assertEqual(model.log_p_katz(n_gram), cache(n_gram))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(4, cache.misses) # ('a', 'great', 'wall') was evicted
+        self.assertEqual(2, len(cache.entries))
+        cache = katzbackoff.LogProbCache(model.log_p_katz)
+        word_bag = "dumpty sat humpty on a wall".split()
+        self.assertEqual(
+            bag_generation.most_likely_sequence(word_bag, model.log_p_katz, 3),
+            bag_generation.most_likely_sequence(word_bag, cache, 3))
+        self.assertGreater(cache.hit_rate(), 0.5)
+        cache.clear()
+        self.assertEqual((0, 0, 0), (cache.hits, cache.misses, len(cache.entries)))
+
+    def _all_log_alphas_and_p_stars(self, trie_node):
+        values = {}
+        for n in range(1, 4):
+            for n_gram, node in self._n_gram_nodes(trie_node, n).items():
+                values[n_gram] = (node.log_alpha, node.log_p_star())
+        return values
+
+    def test_update_model(self):
+        first = ("Humpty Dumpty sat on a wall, "
+                 "Humpty Dumpty had a great fall; "
+                 "All the king's horses and all the king's men "
+                 "Couldn't put Dumpty together again.")
+        second = "All the king's men sat on the wall with Humpty Dumpty."
+        expected = katzbackoff.populate_trie_nodes(io.StringIO(first), 3)
+        katzbackoff.populate_trie_nodes(io.StringIO(second), 3, trie_node=expected)
+        expected = self._all_log_alphas_and_p_stars(
+            katzbackoff.compute_model(expected, 3))
+        model = katzbackoff.LanguageModel(katzbackoff.compute_model(
+            katzbackoff.populate_trie_nodes(io.StringIO(first), 3), 3), 3)
+        katzbackoff.update_model(
+            model, tokenizer.tokenize(io.StringIO(second)), discount_tolerance=0)
+        updated = self._all_log_alphas_and_p_stars(model.trie_node)
+        self.assertEqual(set(expected), set(updated))
+        for n_gram, (log_alpha, log_p_star) in expected.items():
+            self.assertAlmostEqual(log_alpha, updated[n_gram][0])
+            self.assertAlmostEqual(log_p_star, updated[n_gram][1])
+
+    def test_update_model_keeping_discounts(self):
+        model = self._pruning_model()
+        katzbackoff.update_model(
+            model, tokenizer.tokenize(io.StringIO("Humpty Dumpty sat on the wall")),
+            discount_tolerance=float('inf'))
+        self._assert_recompiled_unchanged(model)
+        self.assertIsNotNone(model.trie_node.find_node(('on', 'the', 'wall')))
+        self._assert_pruned_trie_consistent(model.trie_node)
+
+    def test_update_pruned_and_loaded_models(self):
+        model = self._pruning_model()
+        katzbackoff.prune(model, min_count=2)
+        katzbackoff.update_model(
+            model, tokenizer.tokenize(io.StringIO("Humpty Dumpty sat on the wall")),
+            discount_tolerance=float('inf'))
+        self._assert_recompiled_unchanged(model)
+        self._assert_pruned_trie_consistent(model.trie_node)
+        with tempfile.TemporaryDirectory() as dir_name:
+            fn = os.path.join(dir_name, "katz.model")
+            katzbackoff.save_model(model, fn)
+            loaded = katzbackoff.load_model(fn)
+        katzbackoff.update_model(
+            loaded, loaded.vocabulary.to_ids(tokenizer.tokenize(io.StringIO(
+                "All the king's men sat on the wall"))),
+            discount_tolerance=float('inf'))
+        self._assert_recompiled_unchanged(loaded)
+        # the count frequencies kept up to date match a recount
+        count_frequencies = loaded.trie_node._count_frequencies
+        katzbackoff._add_count_frequencies(
+            loaded.trie_node, katzbackoff._trie_levels(loaded.trie_node, 3),
+            loaded.start)
+        self.assertEqual(loaded.trie_node._count_frequencies, count_frequencies)
+
+    def _assert_recompiled_unchanged(self, model):
+        updated = self._all_log_alphas_and_p_stars(model.trie_node)
+        # recompiling everything with the same discounters changes nothing
+        levels = katzbackoff._trie_levels(model.trie_node, model.N)
+        for level in levels:
+            katzbackoff._add_probabilities(level)
+        for level in levels[1:]:
+            katzbackoff._add_alphas(level)
+        for n_gram, (log_alpha, log_p_star) in self._all_log_alphas_and_p_stars(
+                model.trie_node).items():
+            self.assertAlmostEqual(log_alpha, updated[n_gram][0])
+            self.assertAlmostEqual(log_p_star, updated[n_gram][1])
+
+    def test_level_helpers(self):
+        f = io.StringIO(
+            "Humpty Dumpty sat on a wall, "
+            "Humpty Dumpty had a great fall; "
+            "All the king's horses and all the king's men "
+            "Couldn't put Dumpty together again.")
+        trie_node = katzbackoff.compute_model(katzbackoff.populate_trie_nodes(f, 3), 3)
+        for n in range(1, 4):
+            gt_counts = {}
+            trie_node.populate_count_frequencies(gt_counts, n)
+            self.assertEqual(trie_node._count_frequencies[n], gt_counts)
+        humpty = trie_node.find_node(("humpty",))
+        discounter = ch4.SimpleGoodTuringCountSmoother(-1.0)
+        humpty.set_discounter(discounter, 3)
+        for n_gram, node in self._n_gram_nodes(trie_node, 3).items():
+            self.assertEqual(n_gram[0] == "humpty", node.discounter is discounter)
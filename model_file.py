@@ -0,0 +1,96 @@
+"""Binary model files
+
+A versioned container for trained models: a fixed preamble, a JSON
+header holding the model kind, its metadata and an index of named arrays,
+then the raw array data, each array 8-byte aligned. read maps the file
+and returns the arrays as memoryviews into the mapping, so loading costs
+no more than parsing the header and every process that loads the same
+file shares its pages.
+"""
+
+from array import array
+import json, mmap, struct, sys
+from tokenizer import Vocabulary
+
+MAGIC = b"NGRAMMDL"
+FORMAT_VERSION = 3
+_PREAMBLE = struct.Struct("<8sII") # magic, format version, header length
+
+def _padding(offset):
+    return -offset % 8
+
+def write(fn, kind, metadata, arrays):
+    """
+    arrays is a mapping of name to array.array (or to a memoryview as
+    returned by read).
+    """
+    index = {}
+    offset = 0
+    for name, arr in arrays.items():
+        typecode = arr.typecode if isinstance(arr, array) else arr.format
+        index[name] = [typecode, offset, len(arr)]
+        offset += len(arr) * arr.itemsize
+        offset += _padding(offset)
+    header = json.dumps({
+        "kind": kind,
+        "byteorder": sys.byteorder,
+        "metadata": metadata,
+        "arrays": index }).encode('utf-8')
+    data_start = _PREAMBLE.size + len(header)
+    data_start += _padding(data_start)
+    with open(fn, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        f.write(bytes(data_start - f.tell()))
+        for name, arr in arrays.items():
+            f.write(arr)
+            f.write(bytes(_padding(f.tell() - data_start)))
+
+def read(fn, kind):
+    """
+    Returns (metadata, arrays) for the model file fn, which must hold a
+    model of the given kind. arrays maps each name to a read-only
+    memoryview of the array's typecode.
+    """
+    with open(fn, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, header_len = _PREAMBLE.unpack_from(mapping, 0)
+    if magic != MAGIC:
+        raise ValueError("{} is not a model file".format(fn))
+    if version != FORMAT_VERSION:
+        raise ValueError("{} has format version {}, expected {}".format(
+            fn, version, FORMAT_VERSION))
+    header = json.loads(
+        mapping[_PREAMBLE.size:_PREAMBLE.size + header_len].decode('utf-8'))
+    if header["kind"] != kind:
+        raise ValueError("{} holds a {} model, not a {} model".format(
+            fn, header["kind"], kind))
+    if header["byteorder"] != sys.byteorder:
+        raise ValueError("{} was written on a {}-endian machine".format(
+            fn, header["byteorder"]))
+    data_start = _PREAMBLE.size + header_len
+    data_start += _padding(data_start)
+    data = memoryview(mapping)
+    arrays = {}
+    for name, (typecode, offset, length) in header["arrays"].items():
+        start = data_start + offset
+        itemsize = array(typecode).itemsize
+        arrays[name] = data[start:start + length * itemsize].cast(typecode)
+    return header["metadata"], arrays
+
+def vocabulary_arrays(vocabulary):
+    """
+    Returns (offsets, blob) arrays encoding vocabulary's tokens: token i
+    is blob[offsets[i]:offsets[i + 1]] in UTF-8.
+    """
+    offsets = array('Q', [0])
+    blob = array('B')
+    for token in vocabulary.tokens:
+        blob.frombytes(token.encode('utf-8'))
+        offsets.append(len(blob))
+    return offsets, blob
+
+def read_vocabulary(offsets, blob):
+    text = bytes(blob)
+    return Vocabulary(text[offsets[i]:offsets[i + 1]].decode('utf-8')
+                      for i in range(len(offsets) - 1))
@@ -0,0 +1,315 @@
+"""N-gram counts in compact sorted arrays
+
+An alternative storage backend for ch4.LanguageModel. Each n-gram of
+vocabulary ids is packed into a single integer key, with the first token
+in the most significant bits, so sorting the keys groups n-grams by their
+n-1 gram history. Counts live in a parallel array, and each history
+stores only its total count and the offset of its first n-gram.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from collections.abc import Mapping
+from itertools import accumulate, islice, repeat
+from operator import lshift, or_
+import random
+from ch4 import LanguageModel, CountFrequency
+from tokenizer import Vocabulary
+import model_file
+
+class KeyPacker(object):
+    def __init__(self, n, vocabulary_size):
+        self.n = n
+        self.vocabulary_size = vocabulary_size
+        self.bits = max(1, (vocabulary_size - 1).bit_length())
+        if self.bits * n > 64:
+            raise ValueError(
+                "{}-grams over a vocabulary of {} don't fit in 64-bit keys".format(
+                    n, vocabulary_size))
+        self.mask = (1 << self.bits) - 1
+
+    def pack(self, n_gram):
+        """
+        Returns None if n_gram contains an id outside the vocabulary the
+        packer was built for (e.g. None for an unknown token).
+        """
+        key = 0
+        for token_id in n_gram:
+            if token_id is None or not 0 <= token_id < self.vocabulary_size:
+                return None
+            key = (key << self.bits) | token_id
+        return key
+
+    def unpack(self, key, n=None):
+        if n is None:
+            n = self.n
+        n_gram = [0] * n
+        for i in range(n - 1, -1, -1):
+            n_gram[i] = key & self.mask
+            key >>= self.bits
+        return tuple(n_gram)
+
+def count_packed_n_grams(token_ids, packer, start_id=0):
+    """
+    Returns a Counter of packed key -> count for the n-grams of
+    token_ids padded with n - 1 start ids. Keys are built by shifting and
+    or-ing offset views of the padded ids with map, and counted in one
+    Counter pass, so no Python code runs per token.
+    """
+    padded = array('Q', repeat(start_id, packer.n - 1))
+    padded.extend(token_ids)
+    keys = iter(padded)
+    for i in range(1, packer.n):
+        keys = map(or_, map(lshift, keys, repeat(packer.bits)),
+                   islice(padded, i, None))
+    return Counter(keys)
+
+class _PackedMapping(Mapping):
+    """
+    Read-only mapping over the sorted keys[lo:hi]. pack and unpack
+    convert between mapping keys and packed keys; value(i) returns the
+    value stored at index i.
+    """
+    def __init__(self, keys, lo, hi, pack, unpack, value):
+        self._keys = keys
+        self.lo = lo
+        self.hi = hi
+        self.pack = pack
+        self.unpack = unpack
+        self.value = value
+
+    def _index(self, k):
+        key = self.pack(k)
+        if key is not None:
+            i = bisect_left(self._keys, key, self.lo, self.hi)
+            if i < self.hi and self._keys[i] == key:
+                return i
+        return None
+
+    def __getitem__(self, k):
+        i = self._index(k)
+        if i is None:
+            raise KeyError(k)
+        return self.value(i)
+
+    def __contains__(self, k):
+        return self._index(k) is not None
+
+    def __iter__(self):
+        return map(self.unpack, islice(self._keys, self.lo, self.hi))
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def items(self):
+        return zip(iter(self), map(self.value, range(self.lo, self.hi)))
+
+    def values(self):
+        return map(self.value, range(self.lo, self.hi))
+
+class _PackedConditionalCounts(object):
+    """
+    Same interface as ch4.ConditionalCounts, for one history.
+    """
+    def __init__(self, count, counts):
+        self.count = count
+        self.counts = counts
+
+class ArrayLanguageModel(LanguageModel):
+    """
+    A read-only ch4.LanguageModel over vocabulary ids, stored in arrays
+    rather than per-n-gram dicts. Build one with from_counts or
+    from_model.
+    """
+    def __init__(self, n, vocabulary, keys, counts, packer=None,
+                 histories=None):
+        """
+        keys are unique packed n-grams in ascending order and counts
+        the parallel array of their counts. histories, if given, is the
+        (history_keys, history_counts, history_offsets) triple as
+        computed by _add_histories.
+        """
+        self.n = n
+        self.vocabulary = vocabulary
+        self.start = vocabulary.start_id
+        self.packer = KeyPacker(n, len(vocabulary)) if packer is None else packer
+        self.keys = keys
+        self._counts = counts
+        self._cumulative_counts = None
+        self._cumulative_history_counts = None
+        self._estimates = None
+        if histories is not None:
+            self.history_keys, self.history_counts, self.history_offsets = histories
+        elif n > 1:
+            self._add_histories()
+
+    @staticmethod
+    def from_counts(n, vocabulary, counts):
+        """
+        counts is a mapping of id n-gram to count, e.g. the counts of a
+        LanguageModel built with a vocabulary.
+        """
+        packer = KeyPacker(n, len(vocabulary))
+        items = sorted((packer.pack(n_gram), count)
+                       for n_gram, count in counts.items())
+        return ArrayLanguageModel(
+            n, vocabulary,
+            array('Q', (key for key, count in items)),
+            array('Q', (count for key, count in items)),
+            packer)
+
+    @staticmethod
+    def from_token_ids(n, vocabulary, token_ids):
+        """
+        Counts the n-grams of token_ids (an id sequence, e.g. an array)
+        the same way ch4.compute_n_gram_model does, directly into packed
+        keys.
+        """
+        packer = KeyPacker(n, len(vocabulary))
+        key_counts = count_packed_n_grams(token_ids, packer, vocabulary.start_id)
+        keys = array('Q', sorted(key_counts))
+        return ArrayLanguageModel(
+            n, vocabulary, keys, array('Q', map(key_counts.__getitem__, keys)),
+            packer)
+
+    @staticmethod
+    def from_model(model):
+        if model.vocabulary is None:
+            raise ValueError("ArrayLanguageModel needs a model over vocabulary ids")
+        return ArrayLanguageModel.from_counts(model.n, model.vocabulary, model.counts)
+
+    def _add_histories(self):
+        bits = self.packer.bits
+        self.history_keys = array('Q')
+        self.history_counts = array('Q')
+        # history i owns keys[history_offsets[i]:history_offsets[i + 1]]
+        self.history_offsets = array('Q')
+        prev_history = None
+        for i, (key, count) in enumerate(zip(self.keys, self._counts)):
+            history = key >> bits
+            if history != prev_history:
+                self.history_keys.append(history)
+                self.history_counts.append(count)
+                self.history_offsets.append(i)
+                prev_history = history
+            else:
+                self.history_counts[-1] += count
+        self.history_offsets.append(len(self.keys))
+
+    def add_n_gram(self, n_gram):
+        raise TypeError("ArrayLanguageModel is read-only")
+
+    def add_n_gram_counts(self, n_gram_counts):
+        raise TypeError("ArrayLanguageModel is read-only")
+
+    @property
+    def counts(self):
+        return _PackedMapping(
+            self.keys, 0, len(self.keys), self.packer.pack,
+            self.packer.unpack, self._counts.__getitem__)
+
+    @property
+    def conditional_counts(self):
+        if self.n == 1:
+            return None
+        return _PackedMapping(
+            self.history_keys, 0, len(self.history_keys), self.packer.pack,
+            lambda key: self.packer.unpack(key, self.n - 1),
+            self._conditional_counts_at)
+
+    def _conditional_counts_at(self, i):
+        packer = self.packer
+        history = self.history_keys[i] << packer.bits
+        def pack(token_id):
+            key = packer.pack((token_id,))
+            return None if key is None else history | key
+        counts = _PackedMapping(
+            self.keys, self.history_offsets[i], self.history_offsets[i + 1],
+            pack, lambda key: key & packer.mask, self._counts.__getitem__)
+        return _PackedConditionalCounts(self.history_counts[i], counts)
+
+    def count(self, n_gram):
+        return self.counts.get(n_gram, 0)
+
+    def n_gram_count_frequencies(self):
+        return [CountFrequency(r, N_r) for r, N_r in Counter(self._counts).items()]
+
+    def n_1_gram_count_frequencies(self):
+        return [CountFrequency(r, N_r)
+                for r, N_r in Counter(self.history_counts).items()]
+
+    def _sample(self, cumulative_counts, lo, hi, rng):
+        """
+        Returns an index in [lo, hi) chosen with probability proportional
+        to its count, given cumulative_counts[i] = sum of counts[:i + 1].
+        """
+        base = cumulative_counts[lo - 1] if lo > 0 else 0
+        rand_index = base + rng.randrange(cumulative_counts[hi - 1] - base)
+        return bisect_right(cumulative_counts, rand_index, lo, hi)
+
+    def gen_random(self, token_length, rng=random):
+        if self._cumulative_counts is None:
+            self._cumulative_counts = array('Q', accumulate(self._counts))
+            self._cumulative_history_counts = array(
+                'Q', accumulate(self.history_counts))
+        bits = self.packer.bits
+        start_shift = bits * (self.n - 2)
+        lo = bisect_left(self.history_keys, self.start << start_shift)
+        hi = bisect_left(self.history_keys, (self.start + 1) << start_shift)
+        history_index = self._sample(
+            self._cumulative_history_counts, lo, hi, rng)
+        history = self.history_keys[history_index]
+        tokens = list(self.packer.unpack(history, self.n - 1))
+        history_mask = (1 << (bits * (self.n - 1))) - 1
+        while len(tokens) < token_length:
+            key = self.keys[self._sample(
+                self._cumulative_counts, self.history_offsets[history_index],
+                self.history_offsets[history_index + 1], rng)]
+            tokens.append(key & self.packer.mask)
+            history = key & history_mask
+            history_index = bisect_left(self.history_keys, history)
+            if (history_index == len(self.history_keys)
+                    or self.history_keys[history_index] != history):
+                raise KeyError(self.packer.unpack(history, self.n - 1))
+        return self.vocabulary.to_tokens(tokens)
+
+def save_language_model(model, fn):
+    """
+    Writes ch4.LanguageModel model, whatever its storage, to fn as a
+    model file; load_language_model maps it back as an
+    ArrayLanguageModel.
+    """
+    if not isinstance(model, ArrayLanguageModel):
+        if model.vocabulary is None:
+            model = LanguageModel(model.n, Vocabulary()).merge(model)
+        model = ArrayLanguageModel.from_model(model)
+    vocabulary_offsets, vocabulary_blob = model_file.vocabulary_arrays(
+        model.vocabulary)
+    arrays = {
+        "keys": model.keys,
+        "counts": model._counts,
+        "vocabulary_offsets": vocabulary_offsets,
+        "vocabulary_blob": vocabulary_blob }
+    if model.n > 1:
+        arrays["history_keys"] = model.history_keys
+        arrays["history_counts"] = model.history_counts
+        arrays["history_offsets"] = model.history_offsets
+    model_file.write(fn, "ngram", {
+        "n": model.n,
+        "packed_vocabulary_size": model.packer.vocabulary_size }, arrays)
+
+def load_language_model(fn):
+    metadata, arrays = model_file.read(fn, "ngram")
+    n = metadata["n"]
+    histories = None
+    if n > 1:
+        histories = (arrays["history_keys"], arrays["history_counts"],
+                     arrays["history_offsets"])
+    return ArrayLanguageModel(
+        n,
+        model_file.read_vocabulary(
+            arrays["vocabulary_offsets"], arrays["vocabulary_blob"]),
+        arrays["keys"], arrays["counts"],
+        KeyPacker(n, metadata["packed_vocabulary_size"]),
+        histories)
@@ -0,0 +1,103 @@
+import unittest
+import array, io, os, random, tempfile
+import ch4, katzbackoff, ngram_arrays, tokenizer
+
+TEXT = ("Humpty Dumpty sat on a wall, "
+        "Humpty Dumpty had a great fall; "
+        "All the king's horses and all the king's men "
+        "Couldn't put Humpty together again.")
+
+class ArrayLanguageModelTests(unittest.TestCase):
+    def _models(self, n):
+        model = ch4.compute_n_gram_model(
+            io.StringIO(TEXT), n, vocabulary=tokenizer.Vocabulary())
+        return model, ngram_arrays.ArrayLanguageModel.from_model(model)
+
+    def test_pack(self):
+        packer = ngram_arrays.KeyPacker(3, 5)
+        self.assertEqual(3, packer.bits)
+        self.assertEqual((4, 0, 2), packer.unpack(packer.pack((4, 0, 2))))
+        self.assertEqual((0, 2), packer.unpack(packer.pack((0, 2)), 2))
+        self.assertIsNone(packer.pack((1, None, 2)))
+        self.assertIsNone(packer.pack((1, 5, 2)))
+        self.assertRaises(ValueError, ngram_arrays.KeyPacker, 5, 1 << 13)
+
+    def test_counts(self):
+        model, array_model = self._models(3)
+        self.assertEqual(model.counts, dict(array_model.counts.items()))
+        self.assertEqual(len(model.counts), len(array_model.counts))
+        for n_gram, count in model.counts.items():
+            self.assertEqual(count, array_model.count(n_gram))
+        self.assertEqual(0, array_model.count((1, 1, 1)))
+        self.assertEqual(0, array_model.count((1, None, 1)))
+
+    def test_conditional_counts(self):
+        model, array_model = self._models(3)
+        conditional_counts = array_model.conditional_counts
+        self.assertEqual(len(model.conditional_counts), len(conditional_counts))
+        for n_1_gram, cond_count in model.conditional_counts.items():
+            array_cond_count = conditional_counts[n_1_gram]
+            self.assertEqual(cond_count.count, array_cond_count.count)
+            self.assertEqual(cond_count.counts, dict(array_cond_count.counts))
+        self.assertFalse((1, 1) in conditional_counts)
+
+    def test_count_frequencies(self):
+        model, array_model = self._models(2)
+        def as_dict(cfs):
+            return { cf.r: cf.N_r for cf in cfs }
+        self.assertEqual(as_dict(model.n_gram_count_frequencies()),
+                         as_dict(array_model.n_gram_count_frequencies()))
+        self.assertEqual(as_dict(model.n_1_gram_count_frequencies()),
+                         as_dict(array_model.n_1_gram_count_frequencies()))
+        probs = array_model.compute_probabilities()
+        self.assertEqual(
+            ('humpty', 'dumpty'), tuple(model.vocabulary.to_tokens(probs[0][0])))
+        self.assertAlmostEqual(0.0250, probs[0][1].sgt_smoothed_probability, places=4)
+
+    def test_from_token_ids(self):
+        for n in [1, 2, 3]:
+            model, array_model = self._models(n)
+            token_ids = array.array('Q', model.vocabulary.lookup_ids(
+                tokenizer.tokenize(io.StringIO(TEXT))))
+            bulk_model = ngram_arrays.ArrayLanguageModel.from_token_ids(
+                n, model.vocabulary, token_ids)
+            self.assertEqual(array_model.keys, bulk_model.keys)
+            self.assertEqual(dict(model.counts), dict(bulk_model.counts.items()))
+
+    def test_gen_random(self):
+        model, array_model = self._models(3)
+        random.seed(0)
+        tokens = array_model.gen_random(12)
+        self.assertEqual(12, len(tokens))
+        self.assertEqual("<s>", tokens[0])
+        ids = list(model.vocabulary.lookup_ids(tokens))
+        for i in range(len(ids) - 2):
+            self.assertTrue(tuple(ids[i:i + 3]) in model.counts)
+
+    def test_save_load(self):
+        model = ch4.compute_n_gram_model(io.StringIO(TEXT), 3)
+        with tempfile.TemporaryDirectory() as dir_name:
+            fn = os.path.join(dir_name, "trigram.model")
+            ngram_arrays.save_language_model(model, fn)
+            loaded = ngram_arrays.load_language_model(fn)
+            vocabulary = loaded.vocabulary
+            self.assertEqual(
+                model.counts,
+                { tuple(vocabulary.to_tokens(k)): v for k, v in loaded.counts.items() })
+            self.assertEqual(
+                sorted(p[1].conditional_probability
+                       for p in model.compute_conditional_probs()),
+                sorted(p[1].conditional_probability
+                       for p in loaded.compute_conditional_probs()))
+            resaved_fn = os.path.join(dir_name, "resaved.model")
+            ngram_arrays.save_language_model(loaded, resaved_fn)
+            with open(fn, 'rb') as f, open(resaved_fn, 'rb') as resaved:
+                self.assertEqual(f.read(), resaved.read())
+            self.assertRaises(
+                ValueError, katzbackoff.load_model, fn)
+
+    def test_gen_random_batch(self):
+        model, array_model = self._models(3)
+        batch = array_model.gen_random_batch(10, 8, seed=2)
+        self.assertEqual(batch, array_model.gen_random_batch(10, 8, seed=2))
+        self.assertEqual(10, len(batch))
@@ -1,5 +1,5 @@
 import unittest
-import io
+import io, os, tempfile
 import tokenizer
 
 class TokenizeTests(unittest.TestCase):
@@ -48,3 +48,62 @@ class TokenizeTests(unittest.TestCase):
         tokens = list(tokenizer.tokenize(f, include_punctuation=False))
         expected_tokens = ['do', 'not', 'do', 'anything', 'holmes']
         self.assertEqual(tokens, expected_tokens)
+
+    def test_compiled_raw_tokenize_matches_raw_tokenize(self):
+        texts = [
+            "Mr. Sherwood said reaction to Sea Containers' proposal "
+            "has been \"very positive.\" In New York Stock Exchange composite "
+            "trading yesterday, Sea Containers closed at $62.625, up 62.5 cents.",
+            "Don't 'do anything', holmes!",
+            "My wife's proposal that we don't 'do anything' at all \n"
+            "is something I haven't thought about just yet. Just go back "
+            "to school and get a Ph.D. or an M.D., you know?",
+            "\n\n'Tis the U.S. Corp., e.g. Inc. vs. co. (1,000,000) a. b.\n",
+            "We've said: I'm here -- they'll go; she'd won't it's 'quoted'.\n",
+            "a,,b ,c, 1,2 x'y 'z: end-\n   \n",
+        ]
+        for text in texts:
+            expected_tokens = list(tokenizer.raw_tokenize(io.StringIO(text)))
+            tokens = list(tokenizer.compiled_raw_tokenize(io.StringIO(text)))
+            self.assertEqual(expected_tokens, tokens)
+            self.assertEqual(
+                list(tokenizer.tokenize(io.StringIO(text), compiled=False)),
+                list(tokenizer.tokenize(io.StringIO(text), compiled=True)))
+
+class ParallelTokenizeTests(unittest.TestCase):
+    def test_matches_sequential_tokenize(self):
+        texts = [
+            "Humpty Dumpty sat on a wall,\nHumpty Dumpty had a great fall;\n" * 50,
+            "",
+            "Don't 'do anything', holmes!\nGet a Ph.D. or an M.D., you know?",
+        ]
+        with tempfile.TemporaryDirectory() as dir_name:
+            filenames = []
+            for i, text in enumerate(texts):
+                fn = os.path.join(dir_name, "{}.txt".format(i))
+                with open(fn, 'w') as f:
+                    f.write(text)
+                filenames.append(fn)
+            expected_tokens = []
+            for fn in filenames:
+                with open(fn, 'r') as f:
+                    expected_tokens.extend(tokenizer.tokenize(f, True))
+            tokens = list(tokenizer.parallel_tokenize(
+                filenames, True, processes=2, shard_bytes=64))
+            self.assertEqual(expected_tokens, tokens)
+            self.assertGreater(
+                len(tokenizer.line_aligned_shards(filenames[0], 64)), 1)
+
+class VocabularyTests(unittest.TestCase):
+    def test_ids(self):
+        vocabulary = tokenizer.Vocabulary()
+        self.assertEqual(0, vocabulary.start_id)
+        self.assertEqual(0, vocabulary.lookup("<s>"))
+        f = io.StringIO("Humpty Dumpty sat on a wall, Humpty Dumpty fell.")
+        ids = list(vocabulary.tokenize_ids(f))
+        self.assertEqual([1, 2, 3, 4, 5, 6, 1, 2, 7], ids)
+        self.assertEqual(8, len(vocabulary))
+        self.assertEqual([2, None], list(vocabulary.lookup_ids(["dumpty", "egg"])))
+        self.assertFalse("egg" in vocabulary)
+        self.assertEqual("Humpty dumpty fell",
+                         tokenizer.detokenize([0, 1, 2, 7], vocabulary))